@@ -0,0 +1,38 @@
+"""Render search text one column per line
+
+Revision ID: 7e2a4c6b8d10
+Revises: 5b7d9f1e3a64
+Create Date: 2026-10-18 18:05:13.740921
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7e2a4c6b8d10"
+down_revision = "5b7d9f1e3a64"
+branch_labels = None
+depends_on = None
+
+TABLES = ["invoices", "paymentmethods", "products", "stores", "payouts"]
+
+
+def set_search_text_function(expression):
+    op.execute(
+        f"""CREATE OR REPLACE FUNCTION update_search_text() RETURNS trigger AS $$
+BEGIN
+    NEW.search_text := {expression};
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql"""
+    )
+    for table in TABLES:
+        op.execute(f"UPDATE {table} SET search_text = NULL")  # recomputed by the trigger
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS hstore")
+    set_search_text_function("(SELECT string_agg(value, E'\\n') FROM each(hstore(NEW) - 'search_text'::text))")
+
+
+def downgrade():
+    set_search_text_function("(SELECT string_agg(value, ' ') FROM jsonb_each_text(to_jsonb(NEW) - 'search_text'))")
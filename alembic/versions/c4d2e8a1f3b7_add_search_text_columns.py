@@ -0,0 +1,56 @@
+"""Add trigram-indexed search text columns
+
+Revision ID: c4d2e8a1f3b7
+Revises: 9a1c3e5f7b20
+Create Date: 2026-10-18 14:03:52.207431
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c4d2e8a1f3b7"
+down_revision = "9a1c3e5f7b20"
+branch_labels = None
+depends_on = None
+
+TABLES = ["invoices", "paymentmethods", "products", "stores", "payouts"]
+
+
+def upgrade():
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    op.execute(
+        """CREATE OR REPLACE FUNCTION update_search_text() RETURNS trigger AS $$
+BEGIN
+    NEW.search_text := (SELECT string_agg(value, ' ') FROM jsonb_each_text(to_jsonb(NEW) - 'search_text'));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql"""
+    )
+    for table in TABLES:
+        op.add_column(table, sa.Column("search_text", sa.Text(), nullable=True))
+        op.execute(
+            f"UPDATE {table} SET search_text = "
+            f"(SELECT string_agg(value, ' ') FROM jsonb_each_text(to_jsonb({table}) - 'search_text'))"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_search_text BEFORE INSERT OR UPDATE ON {table} "
+            "FOR EACH ROW EXECUTE PROCEDURE update_search_text()"
+        )
+        op.create_index(
+            f"{table}_search_idx",
+            table,
+            ["search_text"],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_ops={"search_text": "gin_trgm_ops"},
+        )
+
+
+def downgrade():
+    for table in TABLES:
+        op.drop_index(f"{table}_search_idx", table_name=table)
+        op.execute(f"DROP TRIGGER IF EXISTS {table}_search_text ON {table}")
+        op.drop_column(table, "search_text")
+    op.execute("DROP FUNCTION IF EXISTS update_search_text()")
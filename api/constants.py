@@ -7,6 +7,11 @@ WEBSITE = "https://bitcartcc.com"  # BitcartCC official site
 GIT_REPO_URL = "https://github.com/bitcartcc/bitcart"  # BitcartCC github repository
 DOCKER_REPO_URL = "https://github.com/bitcartcc/bitcart-docker"  # BitcartCC Docker Packaging repository
 MAX_CONFIRMATION_WATCH = 6  # maximum number of confirmations to save
+PENDING_CHECK_PAGE_SIZE = 500  # number of pending payment methods fetched at once on daemon reconnect
+PENDING_CHECK_CONCURRENCY = 20  # maximum number of pending invoices updated concurrently on daemon reconnect
+EXPIRATION_SWEEP_INTERVAL = 60 * 5  # how often to check for expired invoices not tracked by the expiration scheduler
+EXPORT_BATCH_SIZE = 500  # number of objects fetched from the database cursor at once during streaming exports
+MAX_INVOICE_BATCH_SIZE = 1000  # maximum number of invoices created by one bulk creation request
 FEE_ETA_TARGETS = [25, 10, 5, 2, 1]  # supported target blocks confirmation ETA fee
 EVENTS_CHANNEL = "events"  # default redis channel for event system (inter-process communication)
 LOGSERVER_PORT = 9020  # port for logserver in the worker
@@ -37,3 +42,25 @@ TFA_RECOVERY_LENGTH = 5  # each part has 5 chars
 FIDO2_REGISTER_KEY = "fido2_register_cache"
 FIDO2_LOGIN_KEY = "fido2_login_cache"
 VERIFY_EMAIL_EXPIRATION = 60 * 60 * 24  # 1 day
+AUTH_CACHE_SIZE = 1024  # maximum number of tokens cached in memory of each process
+AUTH_CACHE_LOCAL_TTL = 5  # in-process token cache expiration
+AUTH_CACHE_TTL = 60  # shared token cache expiration in redis
+RATE_CACHE_SIZE = 1024  # maximum number of (currency, contract, fiat) exchange rates cached in memory
+RATE_CACHE_TTL = 60  # exchange rates cache expiration, daemons refresh their rates every 150 seconds
+COIN_POOL_SIZE = 256  # maximum number of coin clients (per currency and xpub) kept for reuse
+WEBSOCKET_QUEUE_SIZE = 100  # messages buffered per websocket client before it is disconnected as too slow
+WEBSOCKET_CHANNELS = ("invoice", "wallet")  # redis channels dispatched to websocket clients
+IPN_CONCURRENCY = 50  # maximum number of IPNs delivered at once by the worker
+IPN_HOST_CONCURRENCY = 4  # maximum number of concurrent IPN requests to a single merchant host
+IPN_TIMEOUT = 10  # IPN request timeout
+IPN_LEASE_TIME = 60  # IPNs claimed by a worker which crashed are retried after this many seconds
+IPN_POLL_INTERVAL = 1  # how often to check for due IPN retries
+IPN_MAX_ATTEMPTS = 8  # IPNs failing this many times are dead-lettered
+IPN_RETRY_BASE = 10  # delay before the first IPN retry, doubled on each next attempt
+IPN_RETRY_MAX = 60 * 60  # maximum delay between IPN retries
+IPN_DEAD_LETTER_SIZE = 1000  # number of dead-lettered IPNs kept for inspection
+NOTIFICATION_WORKERS = 8  # threads sending notifications and emails
+NOTIFICATION_BATCH_SIZE = 20  # messages sent to one notification provider or SMTP server in one executor job
+SMTP_IDLE_TIMEOUT = 60  # SMTP connections idle for longer than this are closed instead of reused
+TEMPLATE_CACHE_SIZE = 1024  # maximum number of compiled custom templates and users' template lookups kept in memory
+TEMPLATE_CACHE_TTL = 10  # users' template lookups expiration, bounds staleness across processes
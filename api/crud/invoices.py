@@ -7,7 +7,8 @@ from operator import attrgetter
 
 from bitcart.errors import errors
 from fastapi import HTTPException
-from sqlalchemy import select, text
+from sqlalchemy import Text, case, cast, select, text
+from sqlalchemy.dialects.postgresql import ARRAY, array
 from starlette.datastructures import CommaSeparatedStrings
 
 from api import db, events, invoices, models, schemes, settings, utils
@@ -20,12 +21,7 @@ from api.utils.database import safe_db_write
 logger = get_logger(__name__)
 
 
-async def validate_stock_levels(products):
-    quantities = (
-        await select([models.Product.id, models.Product.name, models.Product.quantity])
-        .where(models.Product.id.in_(list(products.keys())))
-        .gino.all()
-    )
+def check_stock_levels(products, quantities):
     for product_id, product_name, quantity in quantities:
         if quantity == -1:  # unlimited quantity
             continue
@@ -39,6 +35,15 @@ async def validate_stock_levels(products):
             )
 
 
+async def validate_stock_levels(products):
+    quantities = (
+        await select([models.Product.id, models.Product.name, models.Product.quantity])
+        .where(models.Product.id.in_(list(products.keys())))
+        .gino.all()
+    )
+    check_stock_levels(products, quantities)
+
+
 async def create_invoice(invoice: schemes.CreateInvoice, user: schemes.User):
     d = invoice.dict()
     start_time = time.time()
@@ -82,6 +87,181 @@ async def create_invoice(invoice: schemes.CreateInvoice, user: schemes.User):
     return await apply_filters("invoice_created", obj)
 
 
+class PaymentRequestBatcher:
+    """Creates payment requests of many payment methods with one add_requests daemon call per coin
+
+    Payment method coroutines are run concurrently; once each of them has either finished or is waiting for its
+    payment request, the pending requests are sent to the daemons
+    """
+
+    def __init__(self):
+        self.pending = defaultdict(list)  # coin -> [(request, future)]
+        self.fees = {}  # (currency, target blocks) -> recommended fee lookup shared by the batch
+        self.running = 0
+        self.waiting = 0
+
+    def get_recommended_fee(self, currency, coin, target_blocks):
+        key = (currency.lower(), target_blocks)
+        if key not in self.fees:
+            self.fees[key] = asyncio.ensure_future(coin.server.recommended_fee(target_blocks))
+        return self.fees[key]
+
+    def get_add_request(self, coin):
+        async def add_request(amount, description="", expire=None):
+            future = asyncio.get_running_loop().create_future()
+            request = {"amount": str(amount), "memo": description, coin.EXPIRATION_KEY: 60 * expire if expire else None}
+            self.pending[coin].append(({**request, "force": True}, future))
+            self.waiting += 1
+            self.maybe_flush()
+            return await future
+
+        return add_request
+
+    async def run(self, coros):
+        self.running += len(coros)
+        return await asyncio.gather(*(self.run_one(coro) for coro in coros))
+
+    async def run_one(self, coro):
+        try:
+            return await coro
+        finally:
+            self.running -= 1
+            self.maybe_flush()
+
+    def maybe_flush(self):
+        if self.pending and self.waiting == self.running:
+            pending, self.pending = self.pending, defaultdict(list)
+            self.waiting = 0
+            for coin, requests in pending.items():
+                utils.tasks.create_task(self.send(coin, requests))
+
+    async def send(self, coin, requests):
+        try:
+            try:
+                results = await coin.server.add_requests([request for request, _ in requests])
+            except errors.ProcedureNotFoundError:  # daemon without batch support
+                results = await asyncio.gather(
+                    *(coin.server.add_request(**request) for request, _ in requests), return_exceptions=True
+                )
+        except Exception as e:
+            results = [e] * len(requests)
+        for (_, future), result in zip(requests, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            elif result is None:
+                future.set_exception(Exception("Failed to create payment request"))
+            elif result.keys() == {"error"}:  # per-request daemon error
+                future.set_exception(Exception(result["error"]))
+            else:
+                future.set_result(result)
+
+
+def prepare_batch_item(item, stores, products, user):
+    d = item.dict()
+    store = stores.get(d["store_id"])
+    if store is None:
+        raise HTTPException(404, f"Store with id {d['store_id']} does not exist!")
+    if not store.checkout_settings.allow_anonymous_invoice_creation and not user:
+        raise HTTPException(403, "Anonymous invoice creation is disabled")
+    if not store.wallets:
+        raise HTTPException(422, "No wallet linked")
+    d["currency"] = d["currency"] or store.default_currency or "USD"
+    d["expiration"] = d["expiration"] or store.checkout_settings.expiration
+    item_products = d.pop("products", {})
+    if isinstance(item_products, list):
+        item_products = {k: 1 for k in item_products}
+    if any(key not in products or products[key].user_id != store.user_id for key in item_products):
+        raise HTTPException(403, "Access denied: attempt to use objects not owned by current user")
+    check_stock_levels(item_products, [(key, products[key].name, products[key].quantity) for key in item_products])
+    d["user_id"] = store.user_id
+    return utils.database.prepare_create_kwargs(models.Invoice, d), item_products
+
+
+async def create_invoices_batch(batch: schemes.CreateInvoiceBatch, user: schemes.User):
+    """Create many invoices at once, sharing store, product, wallet and discount lookups between them
+
+    Invoices, their products and payment methods are inserted with multi-row inserts. Errors are reported per invoice
+    """
+    start_time = time.time()
+    logger.info(f"Started creating {len(batch.invoices)} invoices")
+    stores = {
+        store.id: store
+        for store in await utils.database.get_objects(models.Store, list({item.store_id for item in batch.invoices}))
+        if not user or store.user_id == user.id
+    }
+    product_ids = set()
+    for item in batch.invoices:
+        product_ids.update(item.products or [])
+    products = {product.id: product for product in await utils.database.get_objects(models.Product, list(product_ids))}
+    results = []
+    prepared = []
+    for item in batch.invoices:
+        try:
+            kwargs, item_products = prepare_batch_item(item, stores, products, user)
+        except HTTPException as e:
+            results.append({"invoice": None, "error": e.detail})
+            continue
+        results.append({"invoice": None, "error": None})
+        prepared.append((len(results) - 1, kwargs, item_products))
+    if not prepared:
+        return results
+    with safe_db_write():
+        await models.Invoice.insert().gino.all([kwargs for _, kwargs, _ in prepared])
+        relations = [
+            {"invoice_id": kwargs["id"], "product_id": key, "count": value}
+            for _, kwargs, item_products in prepared
+            for key, value in item_products.items()
+        ]
+        if relations:
+            await models.ProductxInvoice.insert().gino.all(relations)
+    wallet_ids = {wallet_id for store in stores.values() for wallet_id in store.wallets}
+    wallets = {
+        wallet.id: wallet for wallet in await utils.database.get_objects(models.Wallet, list(wallet_ids), postprocess=False)
+    }
+    discount_ids = {discount_id for product in products.values() for discount_id in product.discounts}
+    current_date = utils.time.now()
+    discounts = {
+        discount.id: discount
+        for discount in await utils.database.get_objects(models.Discount, list(discount_ids))
+        if current_date <= discount.end_date
+    }
+    batcher = PaymentRequestBatcher()
+    objects = []
+    coros = []
+    for index, kwargs, item_products in prepared:
+        obj = await apply_filters("db_create_invoice", models.Invoice(**kwargs))
+        objects.append((index, obj))
+        store = stores[obj.store_id]
+        product = products[next(iter(item_products))] if item_products else None
+        product_discounts = [discounts[x] for x in product.discounts if x in discounts] if product else []
+        coros.extend(
+            await get_payment_method_coros(
+                obj,
+                [wallets[x] for x in store.wallets if x in wallets],
+                product_discounts,
+                store,
+                product,
+                kwargs.get("promocode"),
+                batcher,
+            )
+        )
+    db_data = get_payment_methods_data(await batcher.run(coros))
+    if db_data:
+        with safe_db_write():
+            await models.PaymentMethod.insert().gino.all(db_data)
+    invoices_list = [obj for _, obj in objects]
+    await models.Invoice.load_data_many(invoices_list)
+    creation_time = time.time() - start_time
+    ids = [obj.id for obj in invoices_list]
+    await models.Invoice.update.values(creation_time=creation_time).where(models.Invoice.id.in_(ids)).gino.status()
+    logger.info(f"Successfully created {len(ids)} invoices with {len(db_data)} payment methods in {creation_time:.2f}s")
+    await events.event_handler.publish("expired_tasks", {"ids": ids})
+    for index, obj in objects:
+        obj.creation_time = creation_time
+        results[index]["invoice"] = await apply_filters("invoice_created", obj)
+    return results
+
+
 async def determine_network_fee(coin, wallet, invoice, store, divisibility):  # pragma: no cover
     if not coin.is_eth_based:
         return Decimal(await coin.server.get_default_fee(100))  # 100 bytes
@@ -120,7 +300,14 @@ def match_discount(price, wallet, invoice, discounts, promocode):
     return price, discount_id
 
 
-async def _create_payment_method(invoice, wallet, product, store, discounts, promocode, lightning=False):
+async def get_recommended_fee(coin, wallet, store, batcher=None):
+    target_blocks = store.checkout_settings.recommended_fee_target_blocks
+    if batcher is not None:
+        return await batcher.get_recommended_fee(wallet.currency, coin, target_blocks)
+    return await coin.server.recommended_fee(target_blocks)
+
+
+async def _create_payment_method(invoice, wallet, product, store, discounts, promocode, lightning=False, batcher=None):
     coin = await settings.settings.get_coin(
         wallet.currency, {"xpub": wallet.xpub, "contract": wallet.contract, **wallet.additional_xpub_data}
     )
@@ -167,16 +354,14 @@ async def _create_payment_method(invoice, wallet, product, store, discounts, pro
         # Must set payment_address, payment_url, lookup_field
         data.update(method)
     else:
-        method = coin.add_request
+        method = batcher.get_add_request(coin) if batcher is not None else coin.add_request
         if lightning:  # pragma: no cover
             try:
                 await coin.node_id  # check if works
                 method = coin.add_invoice
             except errors.LightningUnsupportedError:
                 return
-        recommended_fee = (
-            await coin.server.recommended_fee(store.checkout_settings.recommended_fee_target_blocks) if not lightning else 0
-        )
+        recommended_fee = await get_recommended_fee(coin, wallet, store, batcher) if not lightning else 0
         recommended_fee = 0 if recommended_fee is None else recommended_fee  # if no rate available, disable it
         data["recommended_fee"] = truncate(Decimal(recommended_fee) / 1024, 2)  # convert to sat/byte, two decimal places
         data_got = await method(request_price, description=product.name if product else "", expire=invoice.expiration)
@@ -213,9 +398,9 @@ async def _create_payment_method(invoice, wallet, product, store, discounts, pro
     )
 
 
-async def create_payment_method(invoice, wallet, product, store, discounts, promocode):
+async def create_payment_method(invoice, wallet, product, store, discounts, promocode, batcher=None):
     results = []
-    method = await _create_payment_method(invoice, wallet, product, store, discounts, promocode)
+    method = await _create_payment_method(invoice, wallet, product, store, discounts, promocode, batcher=batcher)
     if method is not SKIP_PAYMENT_METHOD:
         results.append(method)
     coin_settings = settings.settings.crypto_settings.get(wallet.currency.lower())
@@ -226,24 +411,16 @@ async def create_payment_method(invoice, wallet, product, store, discounts, prom
     return results
 
 
-async def create_method_for_wallet(invoice, wallet, discounts, store, product, promocode):
+async def create_method_for_wallet(invoice, wallet, discounts, store, product, promocode, batcher=None):
     try:
-        return await create_payment_method(invoice, wallet, product, store, discounts, promocode)
+        return await create_payment_method(invoice, wallet, product, store, discounts, promocode, batcher)
     except Exception as e:
         logger.error(
             f"Invoice {invoice.id}: failed creating payment method {wallet.currency.upper()}:\n{get_exception_message(e)}"
         )
 
 
-async def update_invoice_payments(invoice, wallets_ids, discounts, store, product, promocode, start_time):
-    logger.info(f"Started adding invoice payments for invoice {invoice.id}")
-    query = text(
-        """SELECT wallets.*
-    FROM   wallets
-    JOIN   unnest((:wallets_ids)::varchar[]) WITH ORDINALITY t(id, ord) USING (id)
-    ORDER  BY t.ord;"""
-    )
-    wallets = await db.db.all(query, wallets_ids=wallets_ids)
+async def get_payment_method_coros(invoice, wallets, discounts, store, product, promocode, batcher=None):
     randomize_selection = store.checkout_settings.randomize_wallet_selection
     if randomize_selection:
         symbols = defaultdict(list)
@@ -253,17 +430,33 @@ async def update_invoice_payments(invoice, wallets_ids, discounts, store, produc
                 symbols[symbol].append(wallet)
             except Exception:  # pragma: no cover
                 pass
-        coros = [
-            create_method_for_wallet(invoice, secrets.choice(symbols[symbol]), discounts, store, product, promocode)
+        return [
+            create_method_for_wallet(invoice, secrets.choice(symbols[symbol]), discounts, store, product, promocode, batcher)
             for symbol in symbols
         ]
-    else:
-        coros = [create_method_for_wallet(invoice, wallet, discounts, store, product, promocode) for wallet in wallets]
+    return [create_method_for_wallet(invoice, wallet, discounts, store, product, promocode, batcher) for wallet in wallets]
+
+
+def get_payment_methods_data(results):
     db_data = []
-    for result in await asyncio.gather(*coros):
+    for result in results:
         if result is not None:
             for method in result:
                 db_data.append({**method, "created": utils.time.now()})
+    return db_data
+
+
+async def update_invoice_payments(invoice, wallets_ids, discounts, store, product, promocode, start_time):
+    logger.info(f"Started adding invoice payments for invoice {invoice.id}")
+    query = text(
+        """SELECT wallets.*
+    FROM   wallets
+    JOIN   unnest((:wallets_ids)::varchar[]) WITH ORDINALITY t(id, ord) USING (id)
+    ORDER  BY t.ord;"""
+    )
+    wallets = await db.db.all(query, wallets_ids=wallets_ids)
+    coros = await get_payment_method_coros(invoice, wallets, discounts, store, product, promocode)
+    db_data = get_payment_methods_data(await asyncio.gather(*coros))
     if db_data:
         await models.PaymentMethod.insert().gino.all(db_data)
     await invoice.load_data()  # add payment methods with correct names and other related objects
@@ -273,23 +466,80 @@ async def update_invoice_payments(invoice, wallets_ids, discounts, store, produc
     await events.event_handler.publish("expired_task", {"id": invoice.id})
 
 
+def case_by_id(mapping, column):
+    return case(mapping, value=models.Invoice.id, else_=column)
+
+
+async def mark_invoices_complete(invoice_ids, user_id):
+    """Complete invoices in bulk, like update_status with the first payment method of each invoice
+
+    Notifications are sent by the worker, stock levels are updated with a single query
+    """
+    eligible = (
+        models.Invoice.query.where(models.Invoice.id.in_(invoice_ids))
+        .where(models.Invoice.user_id == user_id)
+        .where(models.Invoice.status != invoices.InvoiceStatus.COMPLETE)
+    )
+    methods = (
+        await select([models.PaymentMethod, models.Invoice.paid_currency])
+        .where(models.PaymentMethod.invoice_id == models.Invoice.id)
+        .where(models.Invoice.id.in_(eligible.with_only_columns([models.Invoice.id])))
+        .distinct(models.PaymentMethod.invoice_id)
+        .order_by(models.PaymentMethod.invoice_id, models.PaymentMethod.created)
+        .gino.load((models.PaymentMethod, models.Invoice.paid_currency))
+        .all()
+    )
+    if not methods:
+        return []
+    # payment details are only overwritten if the invoice wasn't paid in another currency
+    matched = {
+        method.invoice_id: method
+        for method, paid_currency in methods
+        if not paid_currency or paid_currency == method.get_name()
+    }
+    values = {"status": invoices.InvoiceStatus.COMPLETE}
+    if matched:
+        values.update(
+            paid_currency=case_by_id(
+                {key: method.get_name() for key, method in matched.items()}, models.Invoice.paid_currency
+            ),
+            discount=case_by_id({key: method.discount for key, method in matched.items()}, models.Invoice.discount),
+            tx_hashes=case(
+                [(models.Invoice.id.in_(list(matched)), cast(array([]), ARRAY(Text)))],
+                else_=models.Invoice.tx_hashes,
+            ),
+            sent_amount=case([(models.Invoice.id.in_(list(matched)), 0)], else_=models.Invoice.sent_amount),
+            exception_status=case_by_id(
+                {
+                    key: (
+                        invoices.InvoiceExceptionStatus.NONE
+                        if method.amount == 0 or method.lightning
+                        else invoices.InvoiceExceptionStatus.PAID_OVER
+                    )
+                    for key, method in matched.items()
+                },
+                models.Invoice.exception_status,
+            ),
+        )
+    completed = [
+        invoice_id
+        for invoice_id, in await models.Invoice.update.values(**values)
+        .where(models.Invoice.id.in_([method.invoice_id for method, _ in methods]))
+        .where(models.Invoice.user_id == user_id)
+        .where(models.Invoice.status != invoices.InvoiceStatus.COMPLETE)
+        .returning(models.Invoice.id)
+        .gino.all()
+    ]
+    if completed:
+        logger.info(f"Updated status of {len(completed)} invoices to {invoices.InvoiceStatus.COMPLETE}")
+        await invoices.update_stock_levels(completed)
+        await events.event_handler.publish("invoices_completed", {"ids": completed})
+    return completed
+
+
 async def batch_invoice_action(query, settings: schemes.BatchSettings, user: schemes.User):
     if settings.command == "mark_complete":
-        for invoice_id in settings.ids:
-            data = (
-                await select([models.Invoice, models.PaymentMethod])
-                .where(models.PaymentMethod.invoice_id == models.Invoice.id)
-                .where(models.Invoice.id == invoice_id)
-                .where(models.Invoice.user_id == user.id)
-                .order_by(models.PaymentMethod.created)
-                .gino.load((models.Invoice, models.PaymentMethod))
-                .first()
-            )
-            if not data:
-                continue
-            invoice, method = data
-            await invoice.load_data()
-            await invoices.update_status(invoice, invoices.InvoiceStatus.COMPLETE, method)
+        await mark_invoices_complete(settings.ids, user.id)
     else:
         await query.gino.status()
     return True
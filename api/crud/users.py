@@ -48,7 +48,7 @@ async def generic_email_code_flow(
         email_settings.get("email"),
         email_settings.get("email_use_ssl"),
     )
-    if not utils.email.check_ping(*args):  # pragma: no cover
+    if not await utils.email.check_ping_async(*args):  # pragma: no cover
         return True
     code = utils.common.unique_id()
     async with utils.redis.wait_for_redis():
@@ -75,4 +75,5 @@ async def change_password(user, password, logout_all=True):
     await utils.database.modify_object(user, {"password": password})
     if logout_all:
         await models.Token.delete.where(models.Token.user_id == user.id).gino.status()
+        await utils.authorization.token_cache.invalidate_users(user.id)
     await run_hook("password_changed", user)
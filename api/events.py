@@ -75,6 +75,12 @@ event_handler = EventHandler(
         "expired_task": {
             "params": {"id"},
         },
+        "expired_tasks": {
+            "params": {"ids"},
+        },
+        "invoices_completed": {
+            "params": {"ids"},
+        },
         "send_verification_email": {
             "params": {"id", "next_url"},
         },
@@ -1,8 +1,16 @@
 import csv
 import io
+import json
+import tempfile
+import zlib
+
+from fastapi.encoders import jsonable_encoder
 
 from api.schemes import DisplayInvoice
 
+EXPORT_FORMATS = {"json": "application/json", "ndjson": "application/x-ndjson", "csv": "application/csv"}
+CSV_CHUNK_SIZE = 64 * 1024
+
 
 def merge_keys(k1, k2):
     return f"{k1}_{k2}" if k1 is not None and k2 is not None else k1 if k1 is not None else k2
@@ -14,10 +22,6 @@ def process_invoice(invoice, add_payments=False):
     return invoice
 
 
-def db_to_json(data, add_payments=False):
-    return map(lambda x: process_invoice(DisplayInvoice.from_orm(x).dict(), add_payments), data)
-
-
 def get_leaves(item, key=None):  # pragma: no cover
     if isinstance(item, list) and key is not None and key != "payments":
         return {key: "[" + ",".join(map(str, item)) + "]"}
@@ -35,15 +39,60 @@ def get_leaves(item, key=None):  # pragma: no cover
         return {key: item}
 
 
-def json_to_csv(json_data):
-    result = io.StringIO()
-    # First parse all entries to get the complete fieldname list
+def get_invoice_dict(invoice, add_payments=False):
+    return process_invoice(DisplayInvoice.from_orm(invoice).dict(), add_payments)
+
+
+async def stream_json(batches, add_payments=False):
+    yield "["
+    first = True
+    async for batch in batches:
+        if not batch:
+            continue
+        chunk = ",".join(json.dumps(jsonable_encoder(get_invoice_dict(item, add_payments))) for item in batch)
+        yield chunk if first else "," + chunk
+        first = False
+    yield "]"
+
+
+async def stream_ndjson(batches, add_payments=False):
+    async for batch in batches:
+        yield "".join(json.dumps(jsonable_encoder(get_invoice_dict(item, add_payments))) + "\n" for item in batch)
+
+
+async def stream_csv(batches, add_payments=False):
+    # CSV header has to list every column, but nested fields (metadata, payments) differ between invoices
+    # So flattened rows are spooled to a temporary file first, and written out once all columns are known
     fieldnames = set()
-    rows = [get_leaves(entry) for entry in json_data]
-    for row in rows:
-        fieldnames.update(row.keys())
-
-    csv_output = csv.DictWriter(result, fieldnames=sorted(fieldnames))
-    csv_output.writeheader()
-    csv_output.writerows(rows)
-    return result
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        async for batch in batches:
+            for item in batch:
+                row = get_leaves(get_invoice_dict(item, add_payments))
+                fieldnames.update(row.keys())
+                spool.write(json.dumps(row, default=str) + "\n")
+        spool.seek(0)
+        result = io.StringIO()
+        csv_output = csv.DictWriter(result, fieldnames=sorted(fieldnames))
+        csv_output.writeheader()
+        for line in spool:
+            csv_output.writerow(json.loads(line))
+            if result.tell() >= CSV_CHUNK_SIZE:
+                yield result.getvalue()
+                result.seek(0)
+                result.truncate()
+        yield result.getvalue()
+
+
+async def stream_export(batches, export_format, add_payments=False):
+    funcs = {"json": stream_json, "ndjson": stream_ndjson, "csv": stream_csv}
+    async for chunk in funcs[export_format](batches, add_payments):
+        yield chunk.encode()
+
+
+async def gzip_stream(chunks):
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)  # gzip container
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
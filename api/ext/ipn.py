@@ -0,0 +1,235 @@
+"""Durable delivery of instant payment notifications (IPN) to merchant endpoints
+
+Jobs are persisted in redis: a sorted set of job ids scored by the time of their next attempt, plus job payloads.
+Claimed jobs are leased for IPN_LEASE_TIME seconds instead of being removed, so that jobs of a crashed worker
+are retried (delivery is at least once). Failed deliveries are retried with exponential backoff and dead-lettered
+after IPN_MAX_ATTEMPTS attempts.
+
+IPNs of one object are delivered one by one, in the order they were queued: each object has a list of its job ids,
+and jobs queued behind another one are parked (scored +inf) until the previous job is delivered or dead-lettered.
+"""
+
+import asyncio
+import json
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from api import constants, settings, utils
+from api.logger import get_exception_message, get_logger
+from api.utils.logging import log_errors
+
+logger = get_logger(__name__)
+
+# store the payload and queue the job, parked if an earlier IPN of the same object is still queued
+ENQUEUE_SCRIPT = """
+local score = ARGV[3]
+if ARGV[2] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[2])
+    if redis.call('RPUSH', ARGV[2], ARGV[1]) > 1 then
+        score = '+inf'
+    end
+end
+redis.call('SET', KEYS[2], ARGV[4])
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+"""
+# remove a delivered or dead-lettered job, and make the next IPN of its object due
+FINISH_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('DEL', KEYS[2])
+local object_key = redis.call('HGET', KEYS[3], ARGV[1])
+if object_key then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('LREM', object_key, 1, ARGV[1])
+    local next_id = redis.call('LINDEX', object_key, 0)
+    if next_id then
+        redis.call('ZADD', KEYS[1], 'XX', ARGV[2], next_id)
+    end
+end
+"""
+# atomically pick due jobs and extend their lease, so that concurrent workers never deliver the same job twice
+CLAIM_SCRIPT = """
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, job_id in ipairs(job_ids) do
+    redis.call('ZADD', KEYS[1], ARGV[2], job_id)
+end
+return job_ids
+"""
+# extend the lease of a job, unless it was lost: the job expired and was claimed again
+RENEW_SCRIPT = """
+if tonumber(redis.call('ZSCORE', KEYS[1], ARGV[1])) ~= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+
+def get_retry_delay(attempts):
+    return min(constants.IPN_RETRY_BASE * 2 ** (attempts - 1), constants.IPN_RETRY_MAX)
+
+
+class IPNDispatcher:
+    def __init__(self, prefix="ipn"):
+        self.queue_key = f"{prefix}:queue"
+        self.job_key = f"{prefix}:job"
+        self.objects_key = f"{prefix}:objects"
+        self.object_key = f"{prefix}:object"
+        self.dead_letter_key = f"{prefix}:dead"
+        self.session = None
+        self.task = None
+        self.wakeup = None
+        self.active = 0
+        self.host_limits = defaultdict(lambda: asyncio.Semaphore(constants.IPN_HOST_CONCURRENCY))
+        self.metrics = {"delivered": 0, "retried": 0, "dead_lettered": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    def get_job_key(self, job_id):
+        return f"{self.job_key}:{job_id}"
+
+    def get_object_key(self, object_id):
+        return f"{self.object_key}:{object_id}" if object_id is not None else ""
+
+    def finish(self, client, job_id):
+        return client.eval(FINISH_SCRIPT, 3, self.queue_key, self.get_job_key(job_id), self.objects_key, job_id, time.time())
+
+    async def enqueue(self, url, data, object_id=None):
+        job_id = utils.common.unique_id()
+        job = {"id": job_id, "url": url, "data": data, "object_id": object_id, "attempts": 0, "created": time.time()}
+        async with utils.redis.wait_for_redis():
+            await settings.settings.redis_pool.eval(
+                ENQUEUE_SCRIPT,
+                3,
+                self.queue_key,
+                self.get_job_key(job_id),
+                self.objects_key,
+                job_id,
+                self.get_object_key(object_id),
+                job["created"],
+                json.dumps(job),
+            )
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return job_id
+
+    async def claim(self, count):
+        now = time.time()
+        lease = now + constants.IPN_LEASE_TIME
+        job_ids = await settings.settings.redis_pool.eval(CLAIM_SCRIPT, 1, self.queue_key, now, lease, count)
+        if not job_ids:
+            return []
+        jobs = []
+        for job_id, job in zip(job_ids, await settings.settings.redis_pool.mget([self.get_job_key(x) for x in job_ids])):
+            if job is None:  # payload is gone, nothing to deliver
+                await self.finish(settings.settings.redis_pool, job_id)
+                continue
+            jobs.append({**json.loads(job), "lease": lease})
+        return jobs
+
+    async def renew_lease(self, job):
+        lease = time.time() + constants.IPN_LEASE_TIME
+        if not await settings.settings.redis_pool.eval(RENEW_SCRIPT, 1, self.queue_key, job["id"], job["lease"], lease):
+            return False
+        job["lease"] = lease
+        return True
+
+    async def post(self, job):
+        async with self.session.post(job["url"], json=job["data"]) as resp:
+            if resp.status >= 400:
+                return f"HTTP {resp.status}"
+        return None
+
+    async def deliver(self, job):
+        base_log_message = f"Sending IPN with data {job['data']} to {job['url']}"
+        async with self.host_limits[urlparse(job["url"]).netloc]:
+            # the job might have waited for the host longer than its lease
+            if not await self.renew_lease(job):
+                logger.info(f"{base_log_message}: skipped, lease expired and the job was claimed again")
+                return
+            try:
+                error = await self.post(job)
+            except Exception as e:
+                error = get_exception_message(e)
+        if error is None:
+            latency = time.time() - job["created"]
+            await self.acknowledge(job, latency)
+            logger.info(f"{base_log_message}: success (attempt {job['attempts'] + 1}, latency {latency:.2f}s)")
+        else:
+            await self.retry(job, error)
+            logger.info(f"{base_log_message}: error (attempt {job['attempts']}): {error}")
+
+    async def acknowledge(self, job, latency=0):
+        await self.finish(settings.settings.redis_pool, job["id"])
+        self.metrics["delivered"] += 1
+        self.metrics["latency_total"] += latency
+        self.metrics["latency_max"] = max(self.metrics["latency_max"], latency)
+
+    async def retry(self, job, error):
+        job.pop("lease", None)
+        job["attempts"] += 1
+        job["error"] = error
+        async with settings.settings.redis_pool.pipeline(transaction=True) as pipe:
+            if job["attempts"] >= constants.IPN_MAX_ATTEMPTS:
+                self.finish(pipe, job["id"])
+                pipe.lpush(self.dead_letter_key, json.dumps(job))
+                pipe.ltrim(self.dead_letter_key, 0, constants.IPN_DEAD_LETTER_SIZE - 1)
+                self.metrics["dead_lettered"] += 1
+            else:
+                pipe.set(self.get_job_key(job["id"]), json.dumps(job))
+                pipe.zadd(self.queue_key, {job["id"]: time.time() + get_retry_delay(job["attempts"])})
+                self.metrics["retried"] += 1
+            await pipe.execute()
+
+    async def get_dead_letters(self, count=constants.IPN_DEAD_LETTER_SIZE):
+        return [json.loads(job) for job in await settings.settings.redis_pool.lrange(self.dead_letter_key, 0, count - 1)]
+
+    @property
+    def stats(self):
+        delivered = self.metrics["delivered"]
+        return {
+            "delivered": delivered,
+            "retried": self.metrics["retried"],
+            "dead_lettered": self.metrics["dead_lettered"],
+            "in_flight": self.active,
+            "latency_avg": self.metrics["latency_total"] / delivered if delivered else 0,
+            "latency_max": self.metrics["latency_max"],
+        }
+
+    async def deliver_job(self, job):
+        try:
+            with log_errors():
+                await self.deliver(job)
+        finally:
+            self.active -= 1
+            self.wakeup.set()
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.session = ClientSession(
+            connector=TCPConnector(limit=constants.IPN_CONCURRENCY), timeout=ClientTimeout(total=constants.IPN_TIMEOUT)
+        )
+        self.task = utils.tasks.create_task(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            capacity = constants.IPN_CONCURRENCY - self.active
+            if capacity > 0:
+                with log_errors():
+                    for job in await self.claim(capacity):
+                        self.active += 1
+                        utils.tasks.create_task(self.deliver_job(job))
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), constants.IPN_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+        if self.session:
+            await self.session.close()
+
+
+dispatcher = IPNDispatcher()
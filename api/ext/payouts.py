@@ -1,8 +1,9 @@
 import asyncio
+from collections import defaultdict
 from decimal import Decimal
 
 import bitcart
-from sqlalchemy import select
+from sqlalchemy import case, select
 
 from api import invoices, models, settings, utils
 from api.ext.moneyformat import currency_table
@@ -31,6 +32,10 @@ async def update_status(payout, status):
     if payout.status == status or payout.status == PayoutStatus.COMPLETE:
         return
     await payout.update(status=status).apply()
+    await process_status_change(payout, status)
+
+
+async def process_status_change(payout, status):
     await utils.notifications.send_ipn(payout, status)
     await run_hook("payout_status", payout, status)
     if status == PayoutStatus.SENT:
@@ -146,31 +151,87 @@ async def send_batch_payouts(payouts, private_key=None):
         await coin.server.close_wallet()
 
 
-async def process_new_block(currency):
-    payouts = (
-        await select([models.Payout, models.Wallet])
-        .where(models.Payout.status == PayoutStatus.SENT)
-        .where(models.Wallet.id == models.Payout.wallet_id)
-        .where(models.Wallet.currency == currency)
-        .gino.load((models.Payout, models.Wallet))
-        .all()
-    )
-    coros = []
-    for payout, wallet in payouts:
-        with log_errors():
-            coin = await settings.settings.get_coin(
-                currency, {"xpub": wallet.xpub, "contract": wallet.contract, **wallet.additional_xpub_data}
-            )
+async def get_tx_confirmations(coin, tx_hashes):
+    try:
+        return await coin.server.get_confirmations(tx_hashes)
+    except bitcart.errors.ProcedureNotFoundError:  # daemon without batch support
+        confirmations = {}
+        for tx_hash in tx_hashes:
             try:
-                confirmations = (await coin.get_tx(payout.tx_hash))["confirmations"]
+                confirmations[tx_hash] = (await coin.get_tx(tx_hash))["confirmations"]
             except bitcart.errors.TxNotFoundError:
-                continue
-            if confirmations >= 1:
-                coros.append(finalize_payout(coin, payout))
-    await asyncio.gather(*coros)
+                confirmations[tx_hash] = None
+        return confirmations
 
 
-async def finalize_payout(coin, payout):
-    used_fee = await coin.server.get_used_fee(payout.tx_hash)
-    await payout.update(used_fee=used_fee).apply()
-    await update_status(payout, PayoutStatus.COMPLETE)
+async def finalize_payouts(payouts, used_fees):
+    completed = {
+        payout_id
+        for payout_id, in await models.Payout.update.values(
+            used_fee=case(used_fees, value=models.Payout.tx_hash), status=PayoutStatus.COMPLETE
+        )
+        .where(models.Payout.id.in_([payout.id for payout in payouts]))
+        .where(models.Payout.status == PayoutStatus.SENT)
+        .returning(models.Payout.id)
+        .gino.all()
+    }
+    for payout in payouts:
+        if payout.id in completed:
+            payout.used_fee = used_fees[payout.tx_hash]
+            payout.status = PayoutStatus.COMPLETE
+            with log_errors():  # issues processing one item
+                await process_status_change(payout, PayoutStatus.COMPLETE)
+
+
+class PayoutTracker:
+    """Completes sent payouts once their transactions are confirmed
+
+    Payouts are grouped by wallet and deduplicated by tx hash, as batch payouts share one transaction. Confirmations
+    of all hashes of a wallet are fetched with a single get_confirmations daemon call. Confirmations only change with
+    new blocks, so payouts are checked at most once per block height.
+    """
+
+    def __init__(self):
+        self.heights = {}  # currency -> last checked block height
+
+    async def process_new_block(self, currency, height=None):
+        if height is not None and self.heights.get(currency, -1) >= height:
+            return
+        payouts = (
+            await select([models.Payout, models.Wallet])
+            .where(models.Payout.status == PayoutStatus.SENT)
+            .where(models.Wallet.id == models.Payout.wallet_id)
+            .where(models.Wallet.currency == currency)
+            .gino.load((models.Payout, models.Wallet))
+            .all()
+        )
+        groups = defaultdict(list)
+        wallets = {}
+        for payout, wallet in payouts:
+            if payout.tx_hash:
+                groups[wallet.id].append(payout)
+                wallets[wallet.id] = wallet
+        results = await asyncio.gather(*(self.check_wallet(wallets[wallet_id], items) for wallet_id, items in groups.items()))
+        # a height is skipped only once all payouts were checked, so failed lookups are retried
+        if height is not None and all(results):
+            self.heights[currency] = max(height, self.heights.get(currency, -1))
+
+    async def check_wallet(self, wallet, payouts):
+        with log_errors():
+            coin = await settings.settings.get_coin(
+                wallet.currency, {"xpub": wallet.xpub, "contract": wallet.contract, **wallet.additional_xpub_data}
+            )
+            tx_hashes = list({payout.tx_hash for payout in payouts})
+            confirmations = await get_tx_confirmations(coin, tx_hashes)
+            confirmed = [tx_hash for tx_hash in tx_hashes if (confirmations.get(tx_hash) or 0) >= 1]
+            used_fees = {}
+            for tx_hash in confirmed:
+                with log_errors():  # issues processing one item
+                    used_fees[tx_hash] = Decimal(await coin.server.get_used_fee(tx_hash))
+            if used_fees:
+                await finalize_payouts([payout for payout in payouts if payout.tx_hash in used_fees], used_fees)
+            return len(used_fees) == len(confirmed)
+        return False
+
+
+payout_tracker = PayoutTracker()
@@ -1,7 +1,12 @@
 import asyncio
+import heapq
+import time
+from collections import defaultdict
+from datetime import timedelta
 from decimal import Decimal
 
-from sqlalchemy import or_, select
+from bitcart.errors import errors
+from sqlalchemy import case, func, or_, select, tuple_
 
 from api import constants, crud, events, models, settings, utils
 from api.ext import payouts as payout_ext
@@ -90,28 +95,95 @@ def get_pending_invoices_query(currency, statuses=None):
     )
 
 
-async def iterate_pending_invoices(currency, statuses=None):
-    with log_errors():  # connection issues
-        async with utils.database.iterate_helper():
-            async for method, invoice, wallet in get_pending_invoices_query(currency, statuses=statuses).gino.load(
-                (models.PaymentMethod, models.Invoice, models.Wallet)
-            ).iterate():
-                await invoice.load_data()
-                yield method, invoice, wallet
-
-
-async def make_expired_task(invoice):
-    invoice.add_invoice_expiration()  # to ensure it is the most recent one
-    left = invoice.time_left + 1  # to ensure it's already expired at that moment
-    if left > 0:
-        await asyncio.sleep(left)
-    try:
-        invoice = await utils.database.get_object(models.Invoice, invoice.id)  # refresh data to get new status
-    except Exception:
-        return  # invoice deleted meantime
-    if invoice.status == InvoiceStatus.PENDING:  # to ensure there are no duplicate notifications
-        await update_status(invoice, InvoiceStatus.EXPIRED)
-        await run_hook("invoice_expired", invoice)
+class PendingLookupIndex:
+    """In-memory set of lookup fields of pending payment methods
+
+    Used by the worker to drop payment events matching no invoice without querying the database.
+    Until the index for a currency is loaded, every lookup is considered a possible match.
+    """
+
+    def __init__(self):
+        self.loaded = set()
+        self.entries = defaultdict(set)  # (currency, lookup_field, contract) -> invoice ids
+        self.contracts = defaultdict(set)  # (currency, lookup_field) -> contracts
+        self.invoices = defaultdict(set)  # invoice id -> entries keys
+        self.recent = {}  # currency -> additions made while loading
+
+    def add(self, invoice_id, currency, lookup_field, contract=None):
+        currency = currency.lower()
+        if currency in self.recent:
+            self.recent[currency].append((invoice_id, currency, lookup_field, contract))
+        key = (currency, lookup_field, contract)
+        self.entries[key].add(invoice_id)
+        self.contracts[(currency, lookup_field)].add(contract)
+        self.invoices[invoice_id].add(key)
+
+    def add_invoice(self, invoice):
+        for method in invoice.payments:
+            if method["lookup_field"]:
+                self.add(invoice.id, method["currency"], method["lookup_field"], method["contract"])
+
+    def remove(self, invoice_id, key):
+        self.invoices[invoice_id].discard(key)
+        if not self.invoices[invoice_id]:
+            del self.invoices[invoice_id]
+        ids = self.entries[key]
+        ids.discard(invoice_id)
+        if ids:
+            return
+        del self.entries[key]
+        currency, lookup_field, contract = key
+        contracts = self.contracts[(currency, lookup_field)]
+        contracts.discard(contract)
+        if not contracts:
+            del self.contracts[(currency, lookup_field)]
+
+    def remove_invoice(self, invoice_id):
+        for key in list(self.invoices.get(invoice_id, ())):
+            self.remove(invoice_id, key)
+
+    def might_match(self, currency, lookup_field, contract=None):
+        currency = currency.lower()
+        if currency not in self.loaded:
+            return True
+        contracts = self.contracts.get((currency, lookup_field))
+        if not contracts:
+            return False
+        return not contract or contract in contracts
+
+    def clear(self, currency):
+        for key, ids in list(self.entries.items()):
+            if key[0] == currency:
+                for invoice_id in list(ids):
+                    self.remove(invoice_id, key)
+
+    async def load(self, currency):
+        currency = currency.lower()
+        self.recent[currency] = []
+        try:
+            rows = (
+                await select(
+                    [models.PaymentMethod.invoice_id, models.PaymentMethod.lookup_field, models.PaymentMethod.contract]
+                )
+                .where(models.PaymentMethod.invoice_id == models.Invoice.id)
+                .where(get_pending_invoice_statuses())
+                .where(models.PaymentMethod.currency == currency)
+                .gino.all()
+            )
+            recent = self.recent.pop(currency)
+            self.clear(currency)
+            for invoice_id, lookup_field, contract in rows:
+                if lookup_field:
+                    self.add(invoice_id, currency, lookup_field, contract)
+            for args in recent:  # invoices created while the query was running
+                self.add(*args)
+            self.loaded.add(currency)
+            logger.debug(f"Loaded {len(rows)} pending payment lookups for {currency.upper()}")
+        finally:
+            self.recent.pop(currency, None)
+
+
+pending_lookups = PendingLookupIndex()
 
 
 async def process_electrum_status(invoice, method, wallet, electrum_status, tx_hashes, sent_amount):
@@ -138,6 +210,8 @@ async def new_payment_handler(
 ):
     with log_errors():
         sent_amount = Decimal(sent_amount)
+        if not pending_lookups.might_match(instance.coin_name, address, contract):
+            return
         query = get_pending_invoices_query(instance.coin_name.lower()).where(models.PaymentMethod.lookup_field == address)
         if contract:
             query = query.where(models.PaymentMethod.contract == contract)
@@ -150,9 +224,14 @@ async def new_payment_handler(
         await process_electrum_status(invoice, method, wallet, status, tx_hashes, sent_amount)
 
 
-async def update_confirmations(invoice, method, confirmations, tx_hashes=[], sent_amount=Decimal(0)):
+async def update_confirmations(invoice, method, confirmations, tx_hashes=[], sent_amount=Decimal(0), store=None):
     await method.update(confirmations=confirmations).apply()
-    store = await utils.database.get_object(models.Store, invoice.store_id)
+    await update_confirmations_status(invoice, method, confirmations, tx_hashes, sent_amount, store=store)
+
+
+async def update_confirmations_status(invoice, method, confirmations, tx_hashes=[], sent_amount=Decimal(0), store=None):
+    if store is None:
+        store = await utils.database.get_object(models.Store, invoice.store_id)
     status = invoice.status
     if confirmations >= 1:
         status = InvoiceStatus.CONFIRMED
@@ -171,19 +250,71 @@ async def get_confirmations(method, wallet):
     )  # don't store arbitrary number of confirmations
 
 
-async def new_block_handler(instance, event, height):
-    coros = []
-    coros.append(payout_ext.process_new_block(instance.coin_name.lower()))
-    async for method, invoice, wallet in iterate_pending_invoices(
-        instance.coin_name.lower(), statuses=[InvoiceStatus.CONFIRMED]
-    ):
+async def get_confirmations_batch(methods, wallet):
+    coin = await settings.settings.get_coin(
+        wallet.currency, {"xpub": wallet.xpub, "contract": methods[0].contract, **wallet.additional_xpub_data}
+    )
+    try:
+        confirmations = await coin.server.get_confirmations([method.lookup_field for method in methods])
+    except errors.ProcedureNotFoundError:  # daemon without batch support
+        confirmations = {method.lookup_field: await get_confirmations(method, wallet) for method in methods}
+    return {
+        key: min(constants.MAX_CONFIRMATION_WATCH, value) for key, value in confirmations.items() if value is not None
+    }  # don't store arbitrary number of confirmations
+
+
+async def save_confirmations(updates):
+    if not updates:
+        return
+    await models.PaymentMethod.update.values(
+        confirmations=case({method.id: confirmations for method, confirmations in updates}, value=models.PaymentMethod.id)
+    ).where(models.PaymentMethod.id.in_([method.id for method, _ in updates])).gino.status()
+
+
+async def refresh_confirmations(currency):
+    groups = defaultdict(list)
+    wallets = {}
+    data = []
+    with log_errors():  # connection issues
+        data = (
+            await get_pending_invoices_query(currency, statuses=[InvoiceStatus.CONFIRMED])
+            .gino.load((models.PaymentMethod, models.Invoice, models.Wallet))
+            .all()
+        )
+    for method, invoice, wallet in data:
+        if method.get_name() != invoice.paid_currency or method.lightning:
+            continue
+        groups[(wallet.id, method.contract)].append((method, invoice))
+        wallets[wallet.id] = wallet
+
+    async def fetch_group(key, items):
+        with log_errors():
+            confirmations = await get_confirmations_batch([method for method, _ in items], wallets[key[0]])
+            return [
+                (method, invoice, confirmations[method.lookup_field])
+                for method, invoice in items
+                if confirmations.get(method.lookup_field, method.confirmations) != method.confirmations
+            ]
+        return []
+
+    changed = [item for result in await asyncio.gather(*(fetch_group(*group) for group in groups.items())) for item in result]
+    await save_confirmations([(method, confirmations) for method, _, confirmations in changed])
+    stores = {}
+    for method, invoice, confirmations in changed:
         with log_errors():  # issues processing one item
-            if invoice.status != InvoiceStatus.CONFIRMED or method.get_name() != invoice.paid_currency or method.lightning:
-                continue
+            method.confirmations = confirmations
+            if invoice.store_id not in stores:
+                stores[invoice.store_id] = await utils.database.get_object(models.Store, invoice.store_id)
             await invoice.load_data()
-            confirmations = await get_confirmations(method, wallet)
-            if confirmations != method.confirmations:
-                coros.append(update_confirmations(invoice, method, confirmations, invoice.tx_hashes, invoice.sent_amount))
+            await update_confirmations_status(
+                invoice, method, confirmations, invoice.tx_hashes, invoice.sent_amount, store=stores[invoice.store_id]
+            )
+
+
+async def new_block_handler(instance, event, height):
+    coros = []
+    coros.append(payout_ext.payout_tracker.process_new_block(instance.coin_name.lower(), height))
+    coros.append(refresh_confirmations(instance.coin_name.lower()))
     coros.append(run_hook("new_block", instance.coin_name.lower(), height))
     # NOTE: if another operation in progress exception occurs, make it await one by one
     await asyncio.gather(*coros)
@@ -198,19 +329,15 @@ async def invoice_notification(invoice: models.Invoice, status: str):
         store = await utils.database.get_object(models.Store, invoice.store_id)
         await utils.notifications.notify(store, await utils.templates.get_notify_template(store, invoice))
         if invoice.products:
-            if utils.email.check_store_ping(store):
+            # no pre-send ping: connection failures are handled and counted by the notification executor
+            if utils.email.check_store_email_settings(store):
                 messages = []
-                products = await utils.database.get_objects(models.Product, invoice.products)
-                for product in products:
+                products_with_counts = await get_invoice_products(invoice)
+                products = [product for product, _ in products_with_counts]
+                for product, quantity in products_with_counts:
                     product.price = currency_table.normalize(
                         invoice.currency, product.price
                     )  # to be formatted correctly in emails
-                    relation = (
-                        await models.ProductxInvoice.query.where(models.ProductxInvoice.invoice_id == invoice.id)
-                        .where(models.ProductxInvoice.product_id == product.id)
-                        .gino.first()
-                    )
-                    quantity = relation.count
                     product_template = await utils.templates.get_product_template(store, product, quantity)
                     messages.append(product_template)
                     logger.debug(
@@ -247,20 +374,32 @@ async def process_notifications(invoice):
     await invoice_notification(invoice, invoice.status)
 
 
-async def update_stock_levels(invoice):
-    quantities = (
-        await select([models.Product.quantity, models.ProductxInvoice.product_id, models.ProductxInvoice.count])
+async def get_invoice_products(invoice):
+    data = (
+        await select([models.Product, models.ProductxInvoice.count])
         .where(models.ProductxInvoice.product_id == models.Product.id)
         .where(models.ProductxInvoice.invoice_id == invoice.id)
-        .gino.all()
+        .gino.load((models.Product, models.ProductxInvoice.count))
+        .all()
+    )
+    await utils.database.postprocess_func([product for product, _ in data])
+    return data
+
+
+async def update_stock_levels(invoice_ids):
+    # a single UPDATE ... FROM statement, computed from current quantities, so concurrent completions can't lose updates
+    counts = (
+        select([models.ProductxInvoice.product_id, func.sum(models.ProductxInvoice.count).label("count")])
+        .where(models.ProductxInvoice.invoice_id.in_(invoice_ids))
+        .group_by(models.ProductxInvoice.product_id)
+        .alias("counts")
+    )
+    await (
+        models.Product.update.values(quantity=func.greatest(models.Product.quantity - counts.c.count, 0))
+        .where(models.Product.id == counts.c.product_id)
+        .where(models.Product.quantity != -1)  # unlimited quantity
+        .gino.status()
     )
-    async with utils.database.iterate_helper():  # transaction (ACID)
-        for product_quantity, product_id, quantity in quantities:
-            if product_quantity == -1:  # unlimited quantity
-                continue
-            await models.Product.update.values(quantity=max(0, product_quantity - quantity)).where(
-                models.Product.id == product_id
-            ).gino.status()
 
 
 async def update_status(invoice, status, method=None, tx_hashes=[], sent_amount=Decimal(0)):
@@ -314,42 +453,196 @@ async def update_status(invoice, status, method=None, tx_hashes=[], sent_amount=
             log_text += f" with payment method {full_method_name}"
         logger.info(f"{log_text} to {status}")
         await invoice.update(status=status).apply()
+        if status not in DEFAULT_PENDING_STATUSES:
+            pending_lookups.remove_invoice(invoice.id)
         if status == InvoiceStatus.COMPLETE:
-            await update_stock_levels(invoice)
+            await update_stock_levels([invoice.id])
         await process_notifications(invoice)
         return True
 
 
-async def create_expired_tasks():
-    with log_errors():
-        async with utils.database.iterate_helper():
-            async for invoice in models.Invoice.query.where(models.Invoice.status == InvoiceStatus.PENDING).gino.iterate():
-                with log_errors():
-                    asyncio.ensure_future(make_expired_task(invoice))
+class ExpirationScheduler:
+    """Expires pending invoices in bulk from a single task
+
+    Keeps a heap of expiration times of pending invoices and wakes up only when the earliest one is due,
+    or every EXPIRATION_SWEEP_INTERVAL seconds to catch invoices it wasn't told about.
+    """
+
+    def __init__(self):
+        self.queue = []  # heap of (expiration timestamp, invoice id)
+        self.wakeup = None
+        self.task = None
+
+    def add(self, invoice_id, expires_at):
+        heapq.heappush(self.queue, (expires_at, invoice_id))
+        if self.wakeup and self.queue[0][1] == invoice_id:
+            self.wakeup.set()
+
+    def schedule(self, invoice):
+        if invoice.status == InvoiceStatus.PENDING:
+            self.add(invoice.id, (invoice.created + timedelta(minutes=invoice.expiration)).timestamp())
+
+    async def load(self):
+        with log_errors():
+            async with utils.database.iterate_helper():
+                async for invoice_id, created, expiration in (
+                    select([models.Invoice.id, models.Invoice.created, models.Invoice.expiration])
+                    .where(models.Invoice.status == InvoiceStatus.PENDING)
+                    .gino.iterate()
+                ):
+                    self.add(invoice_id, (created + timedelta(minutes=expiration)).timestamp())
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.task = utils.tasks.create_task(self.run())
+
+    async def run(self):
+        while True:
+            timeout = constants.EXPIRATION_SWEEP_INTERVAL
+            if self.queue:
+                timeout = min(timeout, max(0, self.queue[0][0] - time.time() + 1))  # to ensure it's already expired
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+                continue  # earlier invoice scheduled, recompute timeout
+            except asyncio.TimeoutError:
+                pass
+            now = time.time()
+            while self.queue and self.queue[0][0] < now:
+                heapq.heappop(self.queue)
+            await self.expire_due()
+
+    async def expire_due(self):
+        with log_errors():
+            expired = (
+                await models.Invoice.update.values(status=InvoiceStatus.EXPIRED)
+                .where(models.Invoice.status == InvoiceStatus.PENDING)
+                .where(models.Invoice.created + models.Invoice.expiration * timedelta(minutes=1) <= utils.time.now())
+                .returning(models.Invoice.id)
+                .gino.all()
+            )
+            if not expired:
+                return
+            for invoice in await utils.database.get_objects(models.Invoice, [invoice_id for invoice_id, in expired]):
+                with log_errors():  # issues processing one item
+                    await process_expired(invoice)
 
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
 
-async def check_pending(currency, process_func=process_electrum_status):
-    coros = []
-    coros.append(payout_ext.process_new_block(currency.lower()))
-    async for method, invoice, wallet in iterate_pending_invoices(currency):
+
+expiration_scheduler = ExpirationScheduler()
+
+
+async def process_expired(invoice):
+    logger.info(f"Updating status of invoice {invoice.id} to {InvoiceStatus.EXPIRED}")
+    pending_lookups.remove_invoice(invoice.id)
+    await process_notifications(invoice)
+    await run_hook("invoice_expired", invoice)
+
+
+async def process_completed(invoice):
+    pending_lookups.remove_invoice(invoice.id)
+    await process_notifications(invoice)
+
+
+async def iterate_pending_pages(currency, statuses=None, page_size=constants.PENDING_CHECK_PAGE_SIZE):
+    """Yield pages of pending payment methods using keyset pagination, without keeping a transaction open"""
+    last_key = None
+    while True:
+        query = get_pending_invoices_query(currency, statuses=statuses).order_by(models.PaymentMethod.id).limit(page_size)
+        if last_key is not None:
+            query = query.where(tuple_(models.PaymentMethod.created, models.PaymentMethod.id) > tuple_(*last_key))
+        page = []
+        with log_errors():  # connection issues
+            page = await query.gino.load((models.PaymentMethod, models.Invoice, models.Wallet)).all()
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_method = page[-1][0]
+        last_key = (last_method.created, last_method.id)
+
+
+async def fetch_request_states(methods, wallet, lightning):
+    coin = await settings.settings.get_coin(
+        wallet.currency, {"xpub": wallet.xpub, "contract": methods[0].contract, **wallet.additional_xpub_data}
+    )
+    if not lightning:
+        try:
+            return await coin.server.get_requests([method.lookup_field for method in methods])
+        except errors.ProcedureNotFoundError:  # daemon without batch support
+            pass
+    states = {}
+    for method in methods:
         with log_errors():  # issues processing one item
-            if invoice.status == InvoiceStatus.EXPIRED:
-                continue
-            coin = await settings.settings.get_coin(
-                method.currency, {"xpub": wallet.xpub, "contract": method.contract, **wallet.additional_xpub_data}
+            states[method.lookup_field] = await (
+                coin.get_invoice(method.lookup_field) if lightning else coin.get_request(method.lookup_field)
             )
-            if method.lightning:
-                invoice_data = await coin.get_invoice(method.lookup_field)
-            else:
-                invoice_data = await coin.get_request(method.lookup_field)
-            coros.append(
-                process_func(
-                    invoice,
-                    method,
-                    wallet,
-                    invoice_data["status"],
-                    invoice_data.get("tx_hashes", []),
-                    Decimal(invoice_data.get("sent_amount", 0)),
-                )
+    return states
+
+
+async def fetch_page_states(page):
+    groups = defaultdict(list)
+    wallets = {}
+    for method, invoice, wallet in page:
+        if invoice.status == InvoiceStatus.EXPIRED:
+            continue
+        groups[(wallet.id, method.contract, method.lightning)].append((method, invoice))
+        wallets[wallet.id] = wallet
+
+    async def fetch_group(key, items):
+        wallet_id, _, lightning = key
+        states = {}
+        with log_errors():
+            states = await fetch_request_states([method for method, _ in items], wallets[wallet_id], lightning)
+        return [
+            (method, invoice, wallets[wallet_id], states[method.lookup_field])
+            for method, invoice in items
+            if states.get(method.lookup_field)
+        ]
+
+    return [item for result in await asyncio.gather(*(fetch_group(*group) for group in groups.items())) for item in result]
+
+
+async def process_pending_state(semaphore, process_func, method, invoice, wallet, invoice_data):
+    async with semaphore:
+        with log_errors():  # issues processing one item
+            await invoice.load_data()
+            await process_func(
+                invoice,
+                method,
+                wallet,
+                invoice_data["status"],
+                invoice_data.get("tx_hashes", []),
+                Decimal(invoice_data.get("sent_amount", 0)),
             )
-    await asyncio.gather(*coros)
+
+
+async def reconcile_pending(currency, process_func=process_electrum_status):
+    semaphore = asyncio.Semaphore(constants.PENDING_CHECK_CONCURRENCY)
+    start_time = time.time()
+    checked = processed = 0
+    async for page in iterate_pending_pages(currency):
+        states = await fetch_page_states(page)
+        await asyncio.gather(*(process_pending_state(semaphore, process_func, *item) for item in states))
+        checked += len(page)
+        processed += len(states)
+        elapsed = time.time() - start_time
+        logger.info(
+            f"Checking pending {currency.upper()} invoices: {checked} checked, {processed} processed"
+            f" ({checked / elapsed if elapsed else 0:.2f} invoices/s)"
+        )
+    elapsed = time.time() - start_time
+    if checked:
+        logger.info(f"Checked {checked} pending {currency.upper()} invoices in {elapsed:.2f}s")
+    return {"checked": checked, "processed": processed, "elapsed": elapsed}
+
+
+async def check_pending(currency, process_func=process_electrum_status):
+    with log_errors():
+        await pending_lookups.load(currency)  # resync lookups missed while disconnected
+    await asyncio.gather(
+        payout_ext.payout_tracker.process_new_block(currency.lower()), reconcile_pending(currency, process_func)
+    )
@@ -1,6 +1,7 @@
 import inspect
 import secrets
 import sys
+from collections import defaultdict
 from datetime import timedelta
 
 import pyotp
@@ -10,7 +11,7 @@ from fastapi import HTTPException
 from fastapi.encoders import jsonable_encoder
 from gino.crud import UpdateRequest
 from gino.declarative import ModelType
-from sqlalchemy import select
+from sqlalchemy import DDL, event, select
 from sqlalchemy.dialects.postgresql import ARRAY
 
 from api import schemes, settings
@@ -30,9 +31,32 @@ Text = db.Text
 ForeignKey = db.ForeignKey
 JSON = db.JSON
 UniqueConstraint = db.UniqueConstraint
+Index = db.Index
 
 logger = get_logger(__name__)
 
+# search_text column of searchable models is maintained by a database trigger concatenating all other columns,
+# one per line, each rendered the same way as a cast to text
+SEARCH_TEXT_COLUMN = "search_text"
+SEARCH_TEXT_FUNCTION = DDL(
+    """CREATE OR REPLACE FUNCTION update_search_text() RETURNS trigger AS $$
+BEGIN
+    NEW.search_text := (SELECT string_agg(value, E'\\n') FROM each(hstore(NEW) - 'search_text'::text));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql"""
+)
+event.listen(db, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+event.listen(db, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS hstore"))
+event.listen(db, "before_create", SEARCH_TEXT_FUNCTION)
+
+
+def get_search_trigger(table_name):
+    return DDL(
+        f"CREATE TRIGGER {table_name}_search_text BEFORE INSERT OR UPDATE ON {table_name} "
+        "FOR EACH ROW EXECUTE PROCEDURE update_search_text()"
+    )
+
 
 async def create_relations(model_id, related_ids, key_info):
     data = [{key_info["current_id"]: model_id, key_info["related_id"]: related_id} for related_id in related_ids]
@@ -52,13 +76,25 @@ class BaseModelMeta(ModelType):
                 new_class.__namespace__["__tablename__"] = f"plugin_{new_class.TABLE_PREFIX}_{new_class.__tablename__}"
             if getattr(new_class, "METADATA", True):
                 new_class.__namespace__["metadata"] = Column(JSON)
+            if getattr(new_class, "SEARCH_INDEX", False):
+                table_name = new_class.__namespace__["__tablename__"]
+                new_class.__namespace__[SEARCH_TEXT_COLUMN] = Column(Text)
+                new_class.__namespace__["_search_index"] = Index(
+                    f"{table_name}_search_idx",
+                    SEARCH_TEXT_COLUMN,
+                    postgresql_using="gin",
+                    postgresql_ops={SEARCH_TEXT_COLUMN: "gin_trgm_ops"},
+                )
         if new_class.__table__ is None:
             new_class.__table__ = getattr(new_class, "_init_table")(new_class)
+            if getattr(new_class, "SEARCH_INDEX", False):
+                event.listen(new_class.__table__, "after_create", get_search_trigger(new_class.__table__.name))
         return new_class
 
 
 class BaseModel(db.Model, metaclass=BaseModelMeta):
     JSON_KEYS: dict = {}
+    SEARCH_INDEX = False  # maintain a trigram-indexed search_text column used by text search
 
     @property
     def M2M_KEYS(self):
@@ -94,6 +130,12 @@ class BaseModel(db.Model, metaclass=BaseModelMeta):
         await self.add_related()
         await self.add_fields()
 
+    @classmethod
+    async def load_data_many(cls, items):
+        """Load related data for a list of objects; override to avoid running queries per object"""
+        for item in items:
+            await item.load_data()
+
     async def _delete(self, *args, **kwargs):
         await self.delete_related()
         return await super()._delete(*args, **kwargs)
@@ -191,7 +233,27 @@ class ManyToManyUpdateRequest(UpdateRequest):
             return await super().apply()
 
 
-class User(BaseModel):
+# Models cached by the authorization token cache must drop their entries on every change
+class AuthCacheUpdateRequest(UpdateRequest):
+    async def apply(self):
+        result = await super().apply()
+        await self._instance.invalidate_auth_cache()
+        return result
+
+
+class AuthCacheMixin:
+    _update_request_cls = AuthCacheUpdateRequest
+
+    async def invalidate_auth_cache(self):  # pragma: no cover
+        raise NotImplementedError()
+
+    async def _delete(self, *args, **kwargs):
+        result = await super()._delete(*args, **kwargs)
+        await self.invalidate_auth_cache()
+        return result
+
+
+class User(AuthCacheMixin, BaseModel):
     __tablename__ = "users"
 
     JSON_KEYS = {"settings": schemes.UserPreferences}
@@ -212,6 +274,11 @@ class User(BaseModel):
     def __str__(self):
         return f"User ID: {self.id}\n\n"
 
+    async def invalidate_auth_cache(self):
+        from api import utils
+
+        await utils.authorization.token_cache.invalidate_users(self.id)
+
     async def add_fields(self):
         await super().add_fields()
         if not self.totp_key:  # pragma: no cover # TODO: remove a few releases later
@@ -336,8 +403,16 @@ class Notification(BaseModel):
         return kwargs
 
 
+class TemplateUpdateRequest(UpdateRequest):
+    async def apply(self):
+        result = await super().apply()
+        self._instance.invalidate_template_cache()
+        return result
+
+
 class Template(BaseModel):
     __tablename__ = "templates"
+    _update_request_cls = TemplateUpdateRequest
 
     id = Column(Text, primary_key=True, index=True)
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
@@ -346,6 +421,22 @@ class Template(BaseModel):
     created = Column(DateTime(True), nullable=False)
     _unique_constaint = UniqueConstraint("user_id", "name")
 
+    def invalidate_template_cache(self):
+        from api import utils
+
+        utils.templates.template_cache.invalidate(self.id, self.user_id)
+
+    @classmethod
+    async def create(cls, **kwargs):
+        model = await super().create(**kwargs)
+        model.invalidate_template_cache()
+        return model
+
+    async def _delete(self, *args, **kwargs):
+        result = await super()._delete(*args, **kwargs)
+        self.invalidate_template_cache()
+        return result
+
 
 class WalletxStore(BaseModel):
     __tablename__ = "walletsxstores"
@@ -384,6 +475,7 @@ class StoreUpdateRequest(ManyToManyUpdateRequest):
 
 class Store(BaseModel):
     __tablename__ = "stores"
+    SEARCH_INDEX = True
     _update_request_cls = StoreUpdateRequest
 
     JSON_KEYS = {
@@ -455,6 +547,7 @@ class ProductUpdateRequest(ManyToManyUpdateRequest):
 
 class Product(BaseModel):
     __tablename__ = "products"
+    SEARCH_INDEX = True
     _update_request_cls = ProductUpdateRequest
 
     id = Column(Text, primary_key=True, index=True)
@@ -507,6 +600,7 @@ class ProductxInvoice(BaseModel):
 
 class PaymentMethod(BaseModel):
     __tablename__ = "paymentmethods"
+    SEARCH_INDEX = True
 
     id = Column(Text, primary_key=True, index=True)
     invoice_id = Column(Text, ForeignKey("invoices.id", ondelete="SET NULL"))
@@ -530,6 +624,7 @@ class PaymentMethod(BaseModel):
     label = Column(Text)
     hint = Column(Text)
     created = Column(DateTime(True), nullable=False)
+    _lookup_index = Index("paymentmethods_lookup_idx", "currency", "lookup_field", "contract")
 
     def __str__(self):
         return f"PaymentMethod:\n"\
@@ -554,15 +649,18 @@ class PaymentMethod(BaseModel):
                f"label: {self.label}\n"\
                f"hint: {self.hint}\n"
 
-    async def to_dict(self, index: int = None):
+    async def to_dict(self, index: int = None, currency: str = None):
         from api import utils
 
         data = super().to_dict()
+        data.pop(SEARCH_TEXT_COLUMN, None)
         invoice_id = data.pop("invoice_id")
-        invoice = await utils.database.get_object(Invoice, invoice_id, load_data=False)  # To avoid recursion
+        if currency is None:
+            invoice = await utils.database.get_object(Invoice, invoice_id, load_data=False)  # To avoid recursion
+            currency = invoice.currency
         data["amount"] = currency_table.format_decimal(self.symbol, self.amount, divisibility=self.divisibility)
-        data["rate"] = currency_table.format_decimal(invoice.currency, self.rate)
-        data["rate_str"] = currency_table.format_currency(invoice.currency, self.rate)
+        data["rate"] = currency_table.format_decimal(currency, self.rate)
+        data["rate_str"] = currency_table.format_currency(currency, self.rate)
         data["name"] = self.get_name(index)
         if data["payment_url"].startswith("ethereum:"):  # pragma: no cover
             data["chain_id"] = self.parse_chain_id(data["payment_url"])
@@ -592,6 +690,7 @@ class PaymentMethod(BaseModel):
 
 class Invoice(BaseModel):
     __tablename__ = "invoices"
+    SEARCH_INDEX = True
 
     KEYS = {
         "products": {
@@ -661,7 +760,7 @@ class Invoice(BaseModel):
             await PaymentMethod.query.where(PaymentMethod.invoice_id == self.id).order_by(PaymentMethod.created).gino.all()
         )
         for index, method in crud.invoices.get_methods_inds(payment_methods):
-            self.payments.append(await method.to_dict(index))
+            self.payments.append(await method.to_dict(index, currency=self.currency))
         await super().add_related()
 
     async def create_related(self):
@@ -696,6 +795,42 @@ class Invoice(BaseModel):
         self.product_names = {name[0]: name[1] for name in names}
         self.refund_id = await select([Refund.id]).where(Refund.invoice_id == self.id).gino.scalar()
 
+    @classmethod
+    async def load_data_many(cls, items):
+        from api import crud
+
+        if not items:
+            return
+        ids = [item.id for item in items]
+        payment_methods = defaultdict(list)
+        for method in (
+            await PaymentMethod.query.where(PaymentMethod.invoice_id.in_(ids)).order_by(PaymentMethod.created).gino.all()
+        ):
+            payment_methods[method.invoice_id].append(method)
+        products = defaultdict(list)
+        for invoice_id, product_id in (
+            await select([ProductxInvoice.invoice_id, ProductxInvoice.product_id])
+            .where(ProductxInvoice.invoice_id.in_(ids))
+            .gino.all()
+        ):
+            if product_id:
+                products[invoice_id].append(product_id)
+        product_ids = list({product_id for invoice_products in products.values() for product_id in invoice_products})
+        names = dict(await select([Product.id, Product.name]).where(Product.id.in_(product_ids)).gino.all())
+        refunds = {}
+        for invoice_id, refund_id in await select([Refund.invoice_id, Refund.id]).where(Refund.invoice_id.in_(ids)).gino.all():
+            refunds.setdefault(invoice_id, refund_id)
+        for item in items:
+            item.payments = [
+                await method.to_dict(index, currency=item.currency)
+                for index, method in crud.invoices.get_methods_inds(payment_methods[item.id])
+            ]
+            item.products = products[item.id]
+            await super(Invoice, item).add_fields()
+            item.add_invoice_expiration()
+            item.product_names = {product_id: names[product_id] for product_id in item.products if product_id in names}
+            item.refund_id = refunds.get(item.id)
+
 
 class Setting(BaseModel):
     __tablename__ = "settings"
@@ -716,7 +851,7 @@ class Setting(BaseModel):
         return kwargs
 
 
-class Token(BaseModel):
+class Token(AuthCacheMixin, BaseModel):
     __tablename__ = "tokens"
 
     id = Column(Text, primary_key=True, index=True)
@@ -732,6 +867,11 @@ class Token(BaseModel):
         kwargs["id"] = secrets.token_urlsafe()
         return kwargs
 
+    async def invalidate_auth_cache(self):
+        from api import utils
+
+        await utils.authorization.token_cache.invalidate_tokens(self.id)
+
 
 class File(BaseModel):
     __tablename__ = "files"
@@ -752,6 +892,7 @@ class File(BaseModel):
 
 class Payout(BaseModel):
     __tablename__ = "payouts"
+    SEARCH_INDEX = True
 
     id = Column(Text, primary_key=True, index=True)
     amount = Column(Numeric(36, 18), nullable=False)
@@ -766,6 +907,7 @@ class Payout(BaseModel):
     used_fee = Column(Numeric(36, 18))
     user_id = Column(Text, ForeignKey(User.id, ondelete="SET NULL"))
     created = Column(DateTime(True), nullable=False)
+    _status_index = Index("payouts_status_idx", "status", "wallet_id")
 
     async def validate(self, kwargs):
         await super().validate(kwargs)
@@ -1,12 +1,17 @@
 import asyncio
-from typing import Callable, Optional, Union
+import base64
+import binascii
+import json
+import operator
+from typing import AsyncIterator, Callable, Optional, Union
 
 import asyncpg
-from fastapi import Query
-from sqlalchemy import Text, and_, func, or_, text
+from fastapi import HTTPException, Query
+from sqlalchemy import Boolean, DateTime, Integer, Numeric, String, Text, and_, cast, func, literal, or_, select, text
 from starlette.requests import Request
 
 from api import models, utils
+from api.constants import EXPORT_BATCH_SIZE
 from api.db import db
 from api.plugins import apply_filters
 
@@ -15,9 +20,62 @@ def get_all_columns_filter(model, text):
     return [
         getattr(model, m.key).cast(Text).op("~*")(text)  # NOTE: not cross-db, postgres case-insensitive regex
         for m in model.__table__.columns
+        if m.key != models.SEARCH_TEXT_COLUMN
     ]
 
 
+def get_search_prefilter(model, text):
+    # search_text holds every column cast to text, one per line. In (?w) mode ^ and $ also match at newlines, so each
+    # row with a matching column matches it too, and the trigram-indexed check never drops results of the column scan.
+    # Embedded options must come first, and \A, \Z or lookarounds could see past column boundaries: skip such patterns
+    if not getattr(model, "SEARCH_INDEX", False) or text.startswith(("(?", "***")):
+        return None
+    if any(token in text for token in ("\\A", "\\Z", "(?=", "(?!", "(?<")):
+        return None
+    return getattr(model, models.SEARCH_TEXT_COLUMN).op("~*")(f"(?w){text}")
+
+
+def get_model_search_filter(model, text):
+    columns_filter = or_(*get_all_columns_filter(model, text))
+    prefilter = get_search_prefilter(model, text)
+    return and_(prefilter, columns_filter) if prefilter is not None else columns_filter
+
+
+def get_text_search_filter(model, text):
+    filters = [get_model_search_filter(model, text)]
+    if model == models.Invoice:
+        payments_search = get_model_search_filter(models.PaymentMethod, text)
+        filters.append(models.Invoice.id.in_(select([models.PaymentMethod.invoice_id]).where(payments_search)))
+    return filters
+
+
+CURSOR_SORT_TYPES = (String, Integer, Numeric, DateTime, Boolean)
+COUNT_MODES = ("exact", "estimated", "none")
+
+
+def encode_cursor(sort, desc, value, item_id):
+    value = str(value) if value is not None else None
+    return base64.urlsafe_b64encode(json.dumps([sort, desc, value, item_id]).encode()).decode()
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def get_keyset_filter(column, id_column, value, item_id, descending):
+    # postgres sorts NULLs first in descending order and last in ascending order
+    op = operator.lt if descending else operator.gt
+    if value is None:
+        nulls = and_(column.is_(None), op(id_column, item_id))
+        return or_(nulls, column.isnot(None)) if descending else nulls
+    value = cast(literal(value, Text), column.type)
+    condition = or_(op(column, value), and_(column == value, op(id_column, item_id)))
+    return condition if descending else or_(condition, column.is_(None))
+
+
 class Pagination:
     default_offset = 0
     default_limit = 5
@@ -33,6 +91,9 @@ class Pagination:
         multiple: bool = Query(default=False),
         sort: str = Query(default=""),
         desc: bool = Query(default=True),
+        after: Optional[str] = Query(default=None),
+        before: Optional[str] = Query(default=None),
+        count: str = Query(default="exact", regex=f"^({'|'.join(COUNT_MODES)})$"),
     ):
         self.request = request
         self.offset = offset
@@ -44,8 +105,16 @@ class Pagination:
         self.sort = sort
         self.desc = desc
         self.desc_s = "desc" if desc else ""
+        self.after = after
+        self.before = before
+        self.count_mode = count
         self.model = None
 
+    @property
+    def cursor_mode(self) -> bool:
+        # opt-in keyset pagination, empty after/before value requests the first/last page
+        return self.after is not None or self.before is not None
+
     def get_previous_url(self) -> Union[None, str]:
         if self.offset <= 0:
             return None
@@ -58,25 +127,104 @@ class Pagination:
             return None
         return str(self.request.url.include_query_params(limit=self.limit, offset=self.offset + self.limit))
 
+    def get_cursor_url(self, key, item) -> str:
+        token = encode_cursor(self.sort, self.desc, getattr(item, self.sort), item.id)
+        url = self.request.url.remove_query_params(keys=["offset", "after", "before"])
+        return str(url.include_query_params(**{key: token}))
+
     async def get_count(self, query) -> int:
         try:
             return await utils.database.get_scalar(query, db.func.count, self.model.id)
         except asyncpg.exceptions.DataError:
             return 0
 
-    async def get_list(self, query) -> list:
+    async def get_count_by_mode(self, query) -> Optional[int]:
+        if self.count_mode == "none":
+            return None
+        if self.count_mode == "estimated":
+            try:
+                return await utils.database.get_estimated_count(query.group_by(self.model.id))
+            except asyncpg.exceptions.DataError:
+                return 0
+        return await self.get_count(query)
+
+    def set_default_sort(self):
         if not self.sort:
             self.sort = "created"
+            self.desc = True
             self.desc_s = "desc"
+
+    def get_sort_column(self):
+        self.set_default_sort()
+        column = self.model.__table__.columns.get(self.sort)
+        if column is None or not isinstance(column.type, CURSOR_SORT_TYPES):
+            raise HTTPException(422, f"Cursor pagination is not supported for sort={self.sort}")
+        return column
+
+    def get_ordered_query(self, query):
+        self.set_default_sort()
         query = query.group_by(self.model.id)
+        return query.order_by(text(f"{self.sort} {self.desc_s}"))
+
+    async def get_list(self, query) -> list:
+        query = self.get_ordered_query(query)
         if self.limit != -1:
             query = query.limit(self.limit)
-        query = query.order_by(text(f"{self.sort} {self.desc_s}"))
         try:
             return await query.offset(self.offset).gino.all()
         except (asyncpg.exceptions.UndefinedColumnError, asyncpg.exceptions.DataError):
             return []
 
+    async def iterate(
+        self, query, postprocess: Optional[Callable] = None, batch_size: int = EXPORT_BATCH_SIZE
+    ) -> AsyncIterator[list]:
+        # server-side cursor: offset and limit are ignored, all matching objects are returned in batches
+        query = self.get_ordered_query(query)
+        batch = []
+        try:
+            async with utils.database.iterate_helper():
+                async for item in query.gino.iterate():
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        yield (await postprocess(batch)) if postprocess else batch
+                        batch = []
+                if batch:
+                    yield (await postprocess(batch)) if postprocess else batch
+        except (asyncpg.exceptions.UndefinedColumnError, asyncpg.exceptions.DataError):
+            return
+
+    async def get_cursor_page(self, query) -> tuple:
+        column = self.get_sort_column()
+        backwards = self.before is not None
+        token = self.before if backwards else self.after
+        descending = self.desc != backwards
+        query = query.group_by(self.model.id)
+        if token:
+            cursor = decode_cursor(token)
+            if not isinstance(cursor, list) or len(cursor) != 4 or cursor[:2] != [self.sort, self.desc]:
+                raise HTTPException(422, "Invalid pagination cursor")
+            query = query.where(get_keyset_filter(column, self.model.id, cursor[2], cursor[3], descending))
+        if descending:
+            query = query.order_by(column.desc(), self.model.id.desc())
+        else:
+            query = query.order_by(column.asc(), self.model.id.asc())
+        if self.limit != -1:
+            query = query.limit(self.limit + 1)
+        try:
+            data = await query.gino.all()
+        except asyncpg.exceptions.DataError:
+            return [], None, None
+        has_more = self.limit != -1 and len(data) > self.limit
+        if has_more:
+            data = data[: self.limit]
+        if backwards:
+            data.reverse()
+        has_next = bool(token) if backwards else has_more
+        has_previous = has_more if backwards else bool(token)
+        next_url = self.get_cursor_url("after", data[-1]) if data and has_next else None
+        previous_url = self.get_cursor_url("before", data[0]) if data and has_previous else None
+        return data, next_url, previous_url
+
     def search(self):
         if not self.query:
             return []
@@ -86,10 +234,8 @@ class Pagination:
             column = getattr(self.model, search_filter, None)
             if column is not None:
                 queries.append(column.in_(value))
-        full_filters = get_all_columns_filter(self.model, self.query.text)
-        if self.model == models.Invoice:
-            full_filters.extend(get_all_columns_filter(models.PaymentMethod, self.query.text))
-        queries.append(or_(*full_filters))
+        if self.query.text:
+            queries.append(or_(*get_text_search_filter(self.model, self.query.text)))
         return and_(*queries)
 
     async def paginate(
@@ -114,13 +260,21 @@ class Pagination:
         )
         if count_only:
             return await self.get_count(query)
-        count, data = await asyncio.gather(self.get_count(query), self.get_list(query))
+        if self.cursor_mode:
+            count, (data, next_url, previous_url) = await asyncio.gather(
+                self.get_count_by_mode(query), self.get_cursor_page(query)
+            )
+        else:
+            count, data = await asyncio.gather(self.get_count_by_mode(query), self.get_list(query))
+            # without an exact count, assume there is a next page when the current one is full
+            next_count = count if self.count_mode == "exact" else self.offset + len(data) + (len(data) == self.limit)
+            next_url, previous_url = self.get_next_url(next_count), self.get_previous_url()
         if postprocess:
             data = await postprocess(data)
         return {
             "count": count,
-            "next": self.get_next_url(count),
-            "previous": self.get_previous_url(),
+            "next": next_url,
+            "previous": previous_url,
             "result": data,
         }
 
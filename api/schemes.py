@@ -8,7 +8,13 @@ from pydantic import BaseModel as PydanticBaseModel
 from pydantic import EmailStr, root_validator, validator, UUID4
 from pydantic.utils import GetterDict as PydanticGetterDict
 
-from api.constants import BACKUP_FREQUENCIES, BACKUP_PROVIDERS, FEE_ETA_TARGETS, MAX_CONFIRMATION_WATCH
+from api.constants import (
+    BACKUP_FREQUENCIES,
+    BACKUP_PROVIDERS,
+    FEE_ETA_TARGETS,
+    MAX_CONFIRMATION_WATCH,
+    MAX_INVOICE_BATCH_SIZE,
+)
 from api.ext.moneyformat import currency_table
 from api.types import Money
 
@@ -510,6 +516,23 @@ class DisplayInvoice(Invoice):
     refund_id: Optional[str]
 
 
+class CreateInvoiceBatch(BaseModel):
+    invoices: List[CreateInvoice]
+
+    @validator("invoices")
+    def validate_invoices(cls, v):
+        if not v:
+            raise HTTPException(422, "No invoices to create")
+        if len(v) > MAX_INVOICE_BATCH_SIZE:
+            raise HTTPException(422, f"At most {MAX_INVOICE_BATCH_SIZE} invoices can be created at once")
+        return v
+
+
+class InvoiceBatchResult(BaseModel):
+    invoice: Optional[DisplayInvoice]
+    error: Optional[str]
+
+
 class TxResponse(BaseModel):
     date: Optional[datetime]
     txid: str
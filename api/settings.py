@@ -9,10 +9,10 @@ import sys
 import traceback
 from contextlib import asynccontextmanager
 from contextvars import ContextVar
-from typing import Dict
+from typing import Any, Dict
 
 import fido2.features
-from aiohttp import ClientSession
+from aiohttp import BasicAuth, ClientSession, TCPConnector
 from bitcart import COINS, APIManager
 from bitcart.coin import Coin
 from fastapi import HTTPException
@@ -23,7 +23,7 @@ from starlette.config import Config
 from starlette.datastructures import CommaSeparatedStrings
 
 from api import db
-from api.constants import GIT_REPO_URL, PLUGINS_SCHEMA_URL, VERSION, WEBSITE
+from api.constants import COIN_POOL_SIZE, GIT_REPO_URL, PLUGINS_SCHEMA_URL, VERSION, WEBSITE
 from api.ext.blockexplorer import EXPLORERS
 from api.ext.notifiers import parse_notifier_schema
 from api.ext.rpc import RPC
@@ -31,11 +31,65 @@ from api.ext.ssh import load_ssh_settings
 from api.logger import configure_logserver, get_exception_message, get_logger
 from api.schemes import SSHSettings
 from api.templates import TemplateManager
+from api.utils.cache import LRUCache
 from api.utils.files import ensure_exists
 
 fido2.features.webauthn_json_mapping.enabled = True
 
 
+class CoinClientPool:
+    """Bounded pool of coin clients, sharing one keep-alive HTTP session per daemon"""
+
+    def __init__(self, maxsize=COIN_POOL_SIZE):
+        self.clients = LRUCache(maxsize=maxsize, on_evict=self.release)
+        self.sessions = {}
+
+    @staticmethod
+    def get_key(coin, xpub):
+        return coin, json.dumps(xpub, sort_keys=True, default=str) if isinstance(xpub, dict) else xpub
+
+    def get_session(self, coin, credentials):
+        session = self.sessions.get(coin)
+        if session is None or session.closed:
+            session = self.sessions[coin] = ClientSession(
+                connector=TCPConnector(), auth=BasicAuth(credentials["rpc_user"], credentials["rpc_pass"])
+            )
+        return session
+
+    def get(self, key):
+        return self.clients.get(key)
+
+    def add(self, key, obj):
+        self.clients.set(key, obj)
+
+    def release(self, key, obj):
+        # detach shared sessions, otherwise they would be closed once the client is garbage collected
+        sessions = getattr(getattr(obj, "server", None), "_sessions", {})
+        shared = set(map(id, self.sessions.values()))
+        for loop, session in list(sessions.items()):
+            if id(session) in shared:
+                del sessions[loop]
+
+    @property
+    def stats(self):
+        open_connections = 0
+        for session in self.sessions.values():
+            connector = session.connector
+            if connector is not None and not connector.closed:
+                open_connections += len(connector._acquired) + sum(map(len, connector._conns.values()))
+        stats = self.clients.stats
+        lookups = stats["hits"] + stats["misses"]
+        return {**stats, "hit_rate": stats["hits"] / lookups if lookups else 0, "open_connections": open_connections}
+
+    async def close(self):
+        for key, obj in self.clients.items():
+            self.release(key, obj)
+        self.clients.clear()
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+
+
 class Settings(BaseSettings):
     enabled_cryptos: CommaSeparatedStrings = Field("btc", env="BITCART_CRYPTOS")
     redis_host: str = Field("redis://localhost", env="REDIS_HOST")
@@ -71,6 +125,11 @@ class Settings(BaseSettings):
     template_manager: TemplateManager = None
     plugins: list = None
     plugins_schema: dict = {}
+    rate_cache: Any = None
+    coin_pool: CoinClientPool = None
+    websocket_broker: Any = None
+    notification_executor: Any = None
+    rate_cache_redis: bool = Field(False, env="BITCART_RATE_CACHE_REDIS")
 
     alchemy_api_key: str = Field(None, env="ALCHEMY_API_KEY")
 
@@ -185,6 +244,25 @@ class Settings(BaseSettings):
         self.load_cryptos()
         self.load_notification_providers()
         self.template_manager = TemplateManager()
+        self.load_rate_cache()
+        self.coin_pool = CoinClientPool()
+        self.load_websocket_broker()
+        self.load_notification_executor()
+
+    def load_rate_cache(self):
+        from api.utils.wallets import RateCache
+
+        self.rate_cache = RateCache(use_redis=self.rate_cache_redis)
+
+    def load_websocket_broker(self):
+        from api.utils.redis import WebsocketBroker
+
+        self.websocket_broker = WebsocketBroker()
+
+    def load_notification_executor(self):
+        from api.utils.notifications import NotificationExecutor
+
+        self.notification_executor = NotificationExecutor()
 
     def load_plugins(self):
         from api.plugins import PluginsManager
@@ -239,10 +317,17 @@ class Settings(BaseSettings):
             raise HTTPException(422, "Unsupported currency")
         if not xpub:
             return self.cryptos[coin]
-        obj = None
+        key = self.coin_pool.get_key(coin, xpub)
+        obj = self.coin_pool.get(key)
+        if obj is not None:
+            return obj
         if coin.upper() in COINS:
-            obj = COINS[coin.upper()](xpub=xpub, **self.crypto_settings[coin]["credentials"])
-        return await apply_filters("get_coin", obj, coin, xpub)
+            credentials = self.crypto_settings[coin]["credentials"]
+            obj = COINS[coin.upper()](xpub=xpub, session=self.coin_pool.get_session(coin, credentials), **credentials)
+        obj = await apply_filters("get_coin", obj, coin, xpub)
+        if obj is not None:
+            self.coin_pool.add(key, obj)
+        return obj
 
     async def get_default_explorer(self, coin):
         from api.plugins import apply_filters
@@ -307,8 +392,11 @@ class Settings(BaseSettings):
         register_filter("get_rate", get_sats_rate)
 
     async def shutdown(self):
+        await self.websocket_broker.close()
+        await self.notification_executor.close()
         if self.redis_pool:
             await self.redis_pool.close()
+        await self.coin_pool.close()
         await self.shutdown_db_engine()
 
     def init_logging(self, worker=True):
@@ -4,6 +4,7 @@ from api.ext.configurator import deploy_task
 from api.ext.shopify import shopify_invoice_update
 from api.logger import get_exception_message, get_logger
 from api.plugins import run_hook
+from api.utils.logging import log_errors
 
 logger = get_logger(__name__)
 
@@ -13,7 +14,24 @@ async def create_expired_task(event, event_data):
     invoice = await utils.database.get_object(models.Invoice, event_data["id"], raise_exception=False)
     if not invoice:
         return
-    await invoices.make_expired_task(invoice)
+    if invoice.status in invoices.DEFAULT_PENDING_STATUSES:
+        invoices.pending_lookups.add_invoice(invoice)
+    invoices.expiration_scheduler.schedule(invoice)
+
+
+@event_handler.on("expired_tasks")
+async def create_expired_tasks(event, event_data):
+    for invoice in await utils.database.get_objects(models.Invoice, event_data["ids"]):
+        if invoice.status in invoices.DEFAULT_PENDING_STATUSES:
+            invoices.pending_lookups.add_invoice(invoice)
+        invoices.expiration_scheduler.schedule(invoice)
+
+
+@event_handler.on("invoices_completed")
+async def process_completed_invoices(event, event_data):
+    for invoice in await utils.database.get_objects(models.Invoice, event_data["ids"]):
+        with log_errors():  # issues processing one item
+            await invoices.process_completed(invoice)
 
 
 @event_handler.on("send_verification_email")
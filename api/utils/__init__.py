@@ -1,5 +1,6 @@
 from api.utils import (
     authorization,
+    cache,
     common,
     database,
     email,
@@ -19,6 +20,7 @@ from api.utils import (
 
 __all__ = [
     "authorization",
+    "cache",
     "common",
     "database",
     "email",
@@ -1,16 +1,29 @@
+import hashlib
+import json
 import secrets
 from typing import Optional
 
 from aiohttp import ClientSession
+from dateutil.parser import isoparse
 from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
 from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from passlib.context import CryptContext
 from starlette.requests import Request
 from starlette.status import HTTP_401_UNAUTHORIZED, HTTP_403_FORBIDDEN
 
-from api import models, schemes, utils
-from api.constants import TFA_RECOVERY_ALPHABET, TFA_RECOVERY_LENGTH
+from api import models, schemes, settings, utils
+from api.constants import AUTH_CACHE_LOCAL_TTL, AUTH_CACHE_SIZE, AUTH_CACHE_TTL, TFA_RECOVERY_ALPHABET, TFA_RECOVERY_LENGTH
+from api.logger import get_exception_message, get_logger
 from api.plugins import run_hook
+from api.utils.cache import LRUCache
+
+logger = get_logger(__name__)
+
+AUTH_CACHE_KEY = "auth_token"
+# token columns shared through redis. The token itself and user data (password hash, 2FA secrets) are never stored there
+TOKEN_CACHE_FIELDS = ("user_id", "app_id", "redirect_url", "permissions", "created")
+AUTH_GENERATION_KEY = f"{AUTH_CACHE_KEY}:generation"
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -42,6 +55,162 @@ async def authenticate_user(email: str, password: str):
     return user, 200
 
 
+def dump_model(obj, fields=None):
+    data = obj.to_dict()
+    if fields is not None:
+        data = {field: data[field] for field in fields}
+    return jsonable_encoder(data)
+
+
+def load_model(model, values):
+    values = values.copy()
+    for column in model.__table__.columns:
+        if isinstance(column.type, models.DateTime) and values.get(column.key) is not None:
+            values[column.key] = isoparse(values[column.key])
+    return model(**values)
+
+
+# fill an entry only if no invalidation happened since the generation was read, before loading data from the database
+SET_SCRIPT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[4])
+redis.call('SADD', KEYS[3], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[4])
+return 1
+"""
+
+
+def hash_token(token_id):
+    return hashlib.sha256(token_id.encode()).hexdigest()
+
+
+class TokenCache:
+    """Token -> (user, token) cache: per-process LRU in front of redis
+
+    Entries are keyed by token hashes. The per-process LRU keeps plain column values of the user and token, so each
+    request gets its own model instances. Redis only keeps TOKEN_CACHE_FIELDS, the user is then loaded by primary key.
+
+    Every invalidation increments a generation counter in redis. Local entries are only used while the generation they
+    were filled at is current, so invalidations from any process apply to all of them, and fills racing with an
+    invalidation are never written to redis
+    """
+
+    def __init__(self):
+        self.local = LRUCache(maxsize=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_LOCAL_TTL)
+        self.stats = {"local_hits": 0, "redis_hits": 0, "misses": 0}
+
+    @staticmethod
+    def token_key(token_hash):
+        return f"{AUTH_CACHE_KEY}:{token_hash}"
+
+    @staticmethod
+    def user_key(user_id):
+        return f"{AUTH_CACHE_KEY}:user:{user_id}"
+
+    async def get_generation(self):
+        try:
+            return await settings.settings.redis_pool.get(AUTH_GENERATION_KEY) or "0"
+        except Exception as e:  # pragma: no cover
+            logger.error(f"Failed to read auth cache:\n{get_exception_message(e)}")
+            return None
+
+    async def get_shared(self, token_id, token_hash):
+        try:
+            raw_data = await settings.settings.redis_pool.get(self.token_key(token_hash))
+        except Exception as e:  # pragma: no cover
+            logger.error(f"Failed to read auth cache:\n{get_exception_message(e)}")
+            return None
+        if raw_data is None:
+            return None
+        token = load_model(models.Token, {**json.loads(raw_data), "id": token_id})
+        user = await models.User.get(token.user_id)
+        if user is None:  # pragma: no cover
+            return None
+        return user, token
+
+    async def get(self, token_id, generation):
+        if generation is None:  # redis unavailable
+            return None
+        token_hash = hash_token(token_id)
+        entry = self.local.get(token_hash)
+        if entry is not None and entry["generation"] == generation:
+            self.stats["local_hits"] += 1
+            return load_model(models.User, entry["user"]), load_model(models.Token, entry["token"])
+        data = await self.get_shared(token_id, token_hash)
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        self.stats["redis_hits"] += 1
+        self.set_local(token_hash, generation, *data)
+        return data
+
+    def set_local(self, token_hash, generation, user, token):
+        self.local.set(token_hash, {"generation": generation, "user": dump_model(user), "token": dump_model(token)})
+
+    async def set(self, token_id, generation, user, token):
+        if generation is None:
+            return
+        token_hash = hash_token(token_id)
+        self.set_local(token_hash, generation, user, token)
+        try:
+            await settings.settings.redis_pool.eval(
+                SET_SCRIPT,
+                3,
+                AUTH_GENERATION_KEY,
+                self.token_key(token_hash),
+                self.user_key(user.id),
+                generation,
+                json.dumps(dump_model(token, TOKEN_CACHE_FIELDS)),
+                token_hash,
+                AUTH_CACHE_TTL,
+            )
+        except Exception as e:  # pragma: no cover
+            logger.error(f"Failed to update auth cache:\n{get_exception_message(e)}")
+
+    async def invalidate_hashes(self, *token_hashes):
+        for token_hash in token_hashes:
+            self.local.pop(token_hash)
+        async with settings.settings.redis_pool.pipeline(transaction=True) as pipe:
+            pipe.incr(AUTH_GENERATION_KEY)
+            if token_hashes:
+                pipe.delete(*map(self.token_key, token_hashes))
+            await pipe.execute()
+
+    async def invalidate_tokens(self, *token_ids):
+        await self.invalidate_hashes(*map(hash_token, token_ids))
+
+    async def invalidate_users(self, *user_ids):
+        user_ids = set(user_ids)
+        token_hashes = set()
+        for user_id in user_ids:
+            token_hashes.update(await settings.settings.redis_pool.smembers(self.user_key(user_id)))
+        await self.invalidate_hashes(*token_hashes)
+        if user_ids:
+            await settings.settings.redis_pool.delete(*map(self.user_key, user_ids))
+
+    def clear(self):
+        self.local.clear()
+
+
+token_cache = TokenCache()
+
+
+async def get_token_data(token_id):
+    # read before the database, so that data loaded concurrently with an invalidation is not cached
+    generation = await token_cache.get_generation()
+    data = await token_cache.get(token_id, generation)
+    if data is not None:
+        return data
+    data = (
+        await models.User.join(models.Token).select(models.Token.id == token_id).gino.load((models.User, models.Token)).first()
+    )
+    if data is not None:
+        await token_cache.set(token_id, generation, *data)
+    return data
+
+
 oauth_kwargs = {
     "tokenUrl": "/token/oauth2",
     "scopes": {
@@ -104,12 +273,7 @@ class AuthDependency(OAuth2PasswordBearer):
         )
         if not token:
             raise exc
-        data = (
-            await models.User.join(models.Token)
-            .select(models.Token.id == token)
-            .gino.load((models.User, models.Token))
-            .first()
-        )
+        data = await get_token_data(token)
         if data is None:
             raise exc
         user, token = data  # first validate data, then unpack
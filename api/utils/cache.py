@@ -0,0 +1,56 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """In-memory least recently used cache with optional per-entry expiration"""
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None, on_evict: Optional[Callable] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.data.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self.data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.evict(key)
+        self.misses += 1
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        ttl = self.ttl if ttl is None else ttl
+        self.data[key] = (value, time.monotonic() + ttl if ttl is not None else None)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.evict(next(iter(self.data)))
+
+    def evict(self, key: Hashable) -> None:
+        value, _ = self.data.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.data.pop(key, None)
+        return entry[0] if entry is not None else default
+
+    def items(self):
+        return [(key, value) for key, (value, _) in self.data.items()]
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self.data)}
@@ -1,9 +1,12 @@
+import json
 from contextlib import asynccontextmanager, contextmanager
 from typing import Type, TypeVar
 
 import asyncpg
 from fastapi import HTTPException
 from sqlalchemy import distinct
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 from api import db, models
 from api.logger import get_exception_message, get_logger
@@ -96,9 +99,27 @@ async def get_scalar(query, func, column, use_distinct=True):
     return await query.with_only_columns([func(column)]).order_by(None).gino.scalar() or 0
 
 
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(element.statement, **kwargs)
+
+
+async def get_estimated_count(query):
+    # planner row estimate, much cheaper than an exact count on big tables
+    plan = await db.db.scalar(Explain(query.order_by(None)))
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
 async def postprocess_func(items):
-    for item in items:
-        await item.load_data()
+    if items:
+        await items[0].load_data_many(items)
     return items
 
 
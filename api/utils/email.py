@@ -3,6 +3,7 @@ import traceback
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
+from api import settings
 from api.logger import get_logger
 
 logger = get_logger(__name__)
@@ -12,9 +13,13 @@ def get_email_dsn(host, port, user, password, email, ssl=True):
     return f"{user}:{password}@{host}:{port}?email={email}&ssl={ssl}"
 
 
+def check_email_settings(host, port, user, password, email):
+    return bool(host and port and user and password and email)
+
+
 def check_ping(host, port, user, password, email, ssl=True):  # pragma: no cover
     dsn = get_email_dsn(host, port, user, password, email, ssl)
-    if not (host and port and user and password and email):
+    if not check_email_settings(host, port, user, password, email):
         logger.debug("Checking ping failed: some parameters empty")
         return False
     try:
@@ -31,27 +36,40 @@ def check_ping(host, port, user, password, email, ssl=True):  # pragma: no cover
         return False
 
 
-def send_mail(
-    host, port, user, password, email, ssl, where, text, subject="Thank you for your purchase", use_html_templates=False
-):  # pragma: no cover
-    if not where:
-        return
+def connect(host, port, user, password, ssl=True):  # pragma: no cover
+    server = smtplib.SMTP(host=host, port=port, timeout=2)
+    if ssl:
+        server.starttls()
+    server.login(user, password)
+    return server
+
+
+def make_message(email, where, text, subject="Thank you for your purchase", use_html_templates=False):
     message_obj = MIMEMultipart()
     message_obj["Subject"] = subject
     message_obj["From"] = email
     message_obj["To"] = where
     message_obj.attach(MIMEText(text, "html" if use_html_templates else "plain"))
-    message = message_obj.as_string()
-    server = smtplib.SMTP(host=host, port=port, timeout=2)
-    if ssl:
-        server.starttls()
-    server.login(user, password)
-    server.sendmail(email, where, message)
-    server.quit()
+    return message_obj.as_string()
+
+
+def send_mail(
+    host, port, user, password, email, ssl, where, text, subject="Thank you for your purchase", use_html_templates=False
+):  # pragma: no cover
+    """Queue an email to be sent by the notification executor, without blocking"""
+    if not where:
+        return
+    settings.settings.notification_executor.send_mail(
+        (host, port, user, password, ssl), email, where, make_message(email, where, text, subject, use_html_templates)
+    )
+
 
+async def check_ping_async(*args):  # pragma: no cover
+    return await settings.settings.notification_executor.run(check_ping, *args)
 
-def check_store_ping(store):
-    return check_ping(
+
+async def check_store_ping(store):
+    return await check_ping_async(
         store.email_host,
         store.email_port,
         store.email_user,
@@ -61,6 +79,10 @@ def check_store_ping(store):
     )
 
 
+def check_store_email_settings(store):
+    return check_email_settings(store.email_host, store.email_port, store.email_user, store.email_password, store.email)
+
+
 def send_store_email(store, where, text, subject="Thank you for your purchase"):  # pragma: no cover
     return send_mail(
         store.email_host,
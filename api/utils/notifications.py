@@ -1,24 +1,30 @@
+import asyncio
+import smtplib
+import time
 import traceback
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from functools import partial
 
 import notifiers
-from aiohttp import ClientSession
 
-from api import models, utils
-from api.logger import get_logger
+from api import constants, models, settings, utils
+from api.logger import get_exception_message, get_logger
 from api.plugins import apply_filters, run_hook
 
 logger = get_logger(__name__)
 
 
 async def send_ipn(obj, status):  # pragma: no cover
+    from api.ext import ipn as ipn_ext
+
     if obj.notification_url:
         data = await apply_filters("ipn_data", {"id": obj.id, "status": status}, obj, status)
-        base_log_message = f"Sending IPN with data {data} to {obj.notification_url}"
+        base_log_message = f"Queueing IPN with data {data} to {obj.notification_url}"
         try:
             await run_hook("send_ipn", obj, status, data)
-            async with ClientSession() as session:
-                await session.post(obj.notification_url, json=data)
+            await ipn_ext.dispatcher.enqueue(obj.notification_url, data, obj.id)
             logger.info(f"{base_log_message}: success")
         except Exception:
             logger.info(f"{base_log_message}: error\n{traceback.format_exc()}")
@@ -42,10 +48,160 @@ def validate_data(provider, data):
     return data
 
 
+def send_notifications(provider, data, messages):  # pragma: no cover
+    failed = 0
+    for message in messages:
+        try:
+            response = provider.notify(message=message, **data)
+            if not response.ok:
+                failed += 1
+                logger.error(f"Error sending {provider.name} notification: {response.errors}")
+        except Exception as e:
+            failed += 1
+            logger.error(f"Error sending {provider.name} notification: {get_exception_message(e)}")
+    return failed
+
+
 async def notify(store, text):  # pragma: no cover
     notification_providers = await utils.database.get_objects(models.Notification, store.notifications)
     for db_provider in notification_providers:
         provider = notifiers.get_notifier(db_provider.provider)
         data = validate_data(provider, db_provider.data)
         await run_hook("notify", db_provider, text, data)
-        provider.notify(message=text, **data)
+        settings.settings.notification_executor.submit(
+            ("notifier", db_provider.id), partial(send_notifications, provider, data), text
+        )
+
+
+def quit_smtp_connection(server):  # pragma: no cover
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        pass
+
+
+class NotificationExecutor:
+    """Sends notifications and emails from a bounded thread pool, off the event loop
+
+    Messages are queued per destination (a notification provider or a store's SMTP server), and every destination
+    is drained by a single consumer in batches of up to NOTIFICATION_BATCH_SIZE messages. A slow server only delays
+    its own messages, and SMTP connections are reused between messages of the same store.
+    """
+
+    def __init__(self, workers=constants.NOTIFICATION_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="notifications")
+        self.queues = defaultdict(deque)
+        self.senders = {}
+        self.consumers = {}
+        self.connections = {}
+        self.idle_timers = {}
+        self.in_flight = 0
+        self.metrics = {"sent": 0, "failed": 0, "batches": 0}
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    def submit(self, destination, send_batch, message):
+        """Queue a message; send_batch(messages) is called in the pool and returns the number of failed messages"""
+        self.queues[destination].append(message)
+        self.senders[destination] = send_batch
+        timer = self.idle_timers.pop(destination, None)
+        if timer is not None:
+            timer.cancel()
+        if destination not in self.consumers:
+            self.consumers[destination] = utils.tasks.create_task(self.consume(destination))
+
+    async def consume(self, destination):
+        queue = self.queues[destination]
+        try:
+            while queue:
+                batch = [queue.popleft() for _ in range(min(len(queue), constants.NOTIFICATION_BATCH_SIZE))]
+                self.in_flight += len(batch)
+                try:
+                    failed = await self.run(self.senders[destination], batch)
+                except Exception as e:
+                    logger.error(f"Error sending notifications to {destination[0]}: {get_exception_message(e)}")
+                    failed = len(batch)
+                finally:
+                    self.in_flight -= len(batch)
+                self.metrics["batches"] += 1
+                self.metrics["sent"] += len(batch) - failed
+                self.metrics["failed"] += failed
+        finally:
+            del self.consumers[destination]
+            if not queue:
+                del self.queues[destination]
+                del self.senders[destination]
+                if destination[0] == "smtp" and destination[1:] in self.connections:
+                    self.idle_timers[destination] = asyncio.get_running_loop().call_later(
+                        constants.SMTP_IDLE_TIMEOUT, self.close_idle_connection, destination
+                    )
+
+    def close_idle_connection(self, destination):
+        # runs on the event loop once a store's queue has been empty for SMTP_IDLE_TIMEOUT; the connection is
+        # detached here, so a consumer started afterwards opens a new one instead of racing with the quit
+        del self.idle_timers[destination]
+        if destination in self.consumers:
+            return
+        entry = self.connections.pop(destination[1:], None)
+        if entry is not None:
+            utils.tasks.create_task(self.run(quit_smtp_connection, entry[0]))
+
+    def send_mail(self, conn_args, email, where, message):
+        key = (*conn_args, email)
+        self.submit(("smtp", *key), partial(self.send_mail_batch, key), (where, message))
+
+    def send_mail_batch(self, key, messages):  # pragma: no cover
+        failed = 0
+        for where, message in messages:
+            try:
+                self.get_smtp_connection(key).sendmail(key[-1], where, message)
+                self.connections[key] = (self.connections[key][0], time.monotonic())
+            except Exception as e:
+                failed += 1
+                self.close_smtp_connection(key)
+                logger.error(f"Error sending email to {where}: {get_exception_message(e)}")
+        return failed
+
+    def get_smtp_connection(self, key):  # pragma: no cover
+        # only called from the single consumer of this store's queue, so a connection is never shared between threads
+        entry = self.connections.get(key)
+        if entry is not None:
+            server, last_used = entry
+            if time.monotonic() - last_used < constants.SMTP_IDLE_TIMEOUT:
+                try:
+                    if server.noop()[0] == 250:
+                        return server
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self.close_smtp_connection(key)
+        server = utils.email.connect(*key[:-1])
+        self.connections[key] = (server, time.monotonic())
+        return server
+
+    def close_smtp_connection(self, key):  # pragma: no cover
+        entry = self.connections.pop(key, None)
+        if entry is not None:
+            quit_smtp_connection(entry[0])
+
+    @property
+    def stats(self):
+        return {
+            "queue_depth": sum(len(queue) for queue in self.queues.values()),
+            "in_flight": self.in_flight,
+            "destinations": len(self.consumers),
+            "smtp_connections": len(self.connections),
+            **self.metrics,
+        }
+
+    async def close(self):
+        tasks = list(self.consumers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for timer in self.idle_timers.values():
+            timer.cancel()
+        self.idle_timers.clear()
+        self.pool.shutdown(wait=False)
+        for key in list(self.connections):
+            self.close_smtp_connection(key)
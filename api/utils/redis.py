@@ -1,8 +1,14 @@
 import asyncio
 import json
+from collections import defaultdict
 from contextlib import asynccontextmanager
 
 from api import settings
+from api.constants import WEBSOCKET_CHANNELS, WEBSOCKET_QUEUE_SIZE
+from api.logger import get_exception_message, get_logger
+from api.utils.tasks import create_task
+
+logger = get_logger(__name__)
 
 
 @asynccontextmanager
@@ -27,3 +33,83 @@ async def publish_message(channel, message):
 async def listen_channel(channel):
     async for message in channel.listen():
         yield json.loads(message["data"])
+
+
+class Subscription:
+    """Local subscriber of a redis channel, with a bounded queue of raw (already JSON-encoded) messages"""
+
+    def __init__(self, channel, maxsize=WEBSOCKET_QUEUE_SIZE):
+        self.channel = channel
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.overflowed = False
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # slow consumer: drop its backlog and stop it instead of buffering without bound
+            self.overflowed = True
+            self.close()
+
+    def close(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def listen(self):
+        while (message := await self.queue.get()) is not None:
+            yield message
+
+
+class WebsocketBroker:
+    """Single redis pubsub connection per process, dispatching websocket channels to local subscribers"""
+
+    def __init__(self):
+        self.channels = defaultdict(set)
+        self.lock = asyncio.Lock()
+        self.pubsub = None
+        self.task = None
+
+    async def start(self):
+        if self.task is not None:
+            return
+        async with self.lock:
+            if self.task is not None:
+                return
+            async with wait_for_redis():
+                self.pubsub = settings.settings.redis_pool.pubsub(ignore_subscribe_messages=True)
+                await self.pubsub.psubscribe(*(f"channel:{name}:*" for name in WEBSOCKET_CHANNELS))
+            self.task = create_task(self.dispatch())
+
+    async def dispatch(self):
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] == "pmessage":
+                        channel = message["channel"][len("channel:") :]
+                        for subscription in list(self.channels.get(channel, ())):
+                            subscription.put(message["data"])
+            except Exception as e:  # redis connection errors, pubsub re-subscribes on reconnect
+                logger.error(f"Error dispatching websocket messages: {get_exception_message(e)}")
+                await asyncio.sleep(1)
+
+    async def subscribe(self, channel):
+        await self.start()
+        subscription = Subscription(channel)
+        self.channels[channel].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self.channels.get(subscription.channel)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.channels[subscription.channel]
+        subscription.close()
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.close()
+        self.task = self.pubsub = None
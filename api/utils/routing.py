@@ -265,6 +265,10 @@ class ModelView:
                 await self.custom_methods["batch_action"](query, settings, user)  # pragma: no cover
             else:  # pragma: no cover
                 await query.gino.status()
+            if self.orm_model == models.User:
+                await utils.authorization.token_cache.invalidate_users(*settings.ids)
+            elif self.orm_model == models.Template:
+                utils.templates.template_cache.clear()
             return True
 
         return batch_action
@@ -273,7 +277,7 @@ class ModelView:
 def get_pagination_model(display_model):
     return create_pydantic_model(
         f"PaginationResponse_{display_model.__name__}",
-        count=(int, ...),
+        count=(Optional[int], ...),
         next=(Optional[str], None),
         previous=(Optional[str], None),
         result=(List[display_model], ...),
@@ -1,10 +1,64 @@
+import hashlib
+
 from api import exceptions, models, settings, templates, utils
+from api.constants import TEMPLATE_CACHE_SIZE, TEMPLATE_CACHE_TTL
 from api.logger import get_logger
+from api.utils.cache import LRUCache
 from api.utils.common import get_object_name
 
 logger = get_logger(__name__)
 
 
+class TemplateCache:
+    """Compiled custom templates, and per-user custom template lookups
+
+    Compiled templates are keyed by (template id, text hash), so an edited template is never served stale.
+    Custom templates of a user are loaded with a single query and cached, including an empty result for users
+    without any, so that the default templates are picked without hitting the database
+    """
+
+    def __init__(self):
+        self.compiled = LRUCache(maxsize=TEMPLATE_CACHE_SIZE)
+        self.users = LRUCache(maxsize=TEMPLATE_CACHE_SIZE, ttl=TEMPLATE_CACHE_TTL)
+
+    async def get_user_templates(self, user_id):
+        user_templates = self.users.get(user_id)
+        if user_templates is None:
+            user_templates = {"ids": {}, "names": {}}
+            for template in await models.Template.query.where(models.Template.user_id == user_id).gino.all():
+                user_templates["ids"][template.id] = template
+                user_templates["names"][template.name] = template
+            self.users.set(user_id, user_templates)
+        return user_templates
+
+    async def get_custom_template(self, name, user_id, obj=None):
+        user_templates = await self.get_user_templates(user_id)
+        if obj and obj.templates.get(name):
+            return user_templates["ids"].get(obj.templates[name])
+        return user_templates["names"].get(name)
+
+    def compile(self, name, custom_template):
+        key = (custom_template.id, hashlib.sha256((custom_template.text or "").encode()).hexdigest())
+        template = self.compiled.get(key)
+        if template is None:
+            template = templates.Template(name, custom_template.text)
+            self.compiled.set(key, template)
+        return template
+
+    def invalidate(self, template_id, user_id):
+        self.users.pop(user_id)
+        for key, _ in self.compiled.items():
+            if key[0] == template_id:
+                self.compiled.pop(key)
+
+    def clear(self):
+        self.compiled.clear()
+        self.users.clear()
+
+
+template_cache = TemplateCache()
+
+
 def get_template_matching_str(name, obj):
     template_str = f'Template matching "{name}"'
     if obj and hasattr(obj, "id"):
@@ -14,16 +68,17 @@ def get_template_matching_str(name, obj):
 
 
 async def get_template(name, user_id=None, obj=None):
-    if obj and obj.templates.get(name):
-        query = models.Template.query.where(models.Template.id == obj.templates[name])
-    else:
-        query = models.Template.query.where(models.Template.name == name)
     if user_id:
-        query = query.where(models.Template.user_id == user_id)
-    custom_template = await utils.database.get_object(models.Template, custom_query=query, raise_exception=False)
+        custom_template = await template_cache.get_custom_template(name, user_id, obj)
+    else:
+        if obj and obj.templates.get(name):
+            query = models.Template.query.where(models.Template.id == obj.templates[name])
+        else:
+            query = models.Template.query.where(models.Template.name == name)
+        custom_template = await utils.database.get_object(models.Template, custom_query=query, raise_exception=False)
     if custom_template:
         logger.info(f'{get_template_matching_str(name,obj)} selected custom template "{custom_template.name}"')
-        return templates.Template(name, custom_template.text)
+        return template_cache.compile(name, custom_template)
     if name in settings.settings.template_manager.templates:
         logger.info(f"{get_template_matching_str(name,obj)} selected default template")
         return settings.settings.template_manager.templates[name]
@@ -1,3 +1,4 @@
+import asyncio
 import math
 from decimal import Decimal
 from typing import Union
@@ -7,7 +8,7 @@ from bitcart.errors import BaseError as BitcartBaseError
 from fastapi import HTTPException
 
 from api import models, settings, utils
-from api.constants import MAX_CONTRACT_DIVISIBILITY
+from api.constants import MAX_CONTRACT_DIVISIBILITY, RATE_CACHE_SIZE, RATE_CACHE_TTL
 from api.ext.moneyformat import currency_table
 from api.logger import get_exception_message, get_logger
 from api.plugins import apply_filters
@@ -15,6 +16,59 @@ from api.plugins import apply_filters
 logger = get_logger(__name__)
 
 
+def get_coin_contract(coin):
+    xpub = getattr(coin, "xpub", None)
+    return xpub.get("contract") if isinstance(xpub, dict) else None
+
+
+class RateCache:
+    """Exchange rates cache keyed by (currency, contract, fiat)
+
+    Concurrent lookups of the same rate share a single daemon call. With use_redis, rates are also shared
+    between worker processes
+    """
+
+    def __init__(self, use_redis=False):
+        self.local = utils.cache.LRUCache(maxsize=RATE_CACHE_SIZE, ttl=RATE_CACHE_TTL)
+        self.use_redis = use_redis
+        self.pending = {}
+
+    @staticmethod
+    def redis_key(key):
+        return "rate:" + ":".join(part or "" for part in key)
+
+    async def get(self, coin, fiat):
+        key = (coin.coin_name.lower(), get_coin_contract(coin), fiat.upper())
+        rate = self.local.get(key)
+        if rate is not None:
+            return rate
+        task = self.pending.get(key)
+        if task is None:
+            task = self.pending[key] = asyncio.ensure_future(self.fetch(coin, key))
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def fetch(self, coin, key):
+        if self.use_redis:
+            cached = await settings.settings.redis_pool.get(self.redis_key(key))
+            if cached is not None:
+                rate = Decimal(cached)
+                self.local.set(key, rate)
+                return rate
+        rate = await coin.rate(key[2])
+        self.local.set(key, rate)
+        if self.use_redis:
+            await settings.settings.redis_pool.set(self.redis_key(key), str(rate), ex=RATE_CACHE_TTL)
+        return rate
+
+    def clear(self):
+        self.local.clear()
+
+
+async def get_coin_rate(coin, currency):
+    return await settings.settings.rate_cache.get(coin, currency)
+
+
 async def get_rate(wallet, currency, fallback_currency=None, coin=None, extra_fallback=True):
     try:
         coin = coin or await settings.settings.get_coin(
@@ -23,11 +77,11 @@ async def get_rate(wallet, currency, fallback_currency=None, coin=None, extra_fa
         symbol = await get_wallet_symbol(wallet, coin)
         if symbol.lower() == currency.lower():
             return Decimal(1)
-        rate = await coin.rate(currency)
+        rate = await get_coin_rate(coin, currency)
         if math.isnan(rate) and fallback_currency:
-            rate = await coin.rate(fallback_currency)
+            rate = await get_coin_rate(coin, fallback_currency)
         if math.isnan(rate) and extra_fallback:
-            rate = await coin.rate("USD")
+            rate = await get_coin_rate(coin, "USD")
         if math.isnan(rate) and extra_fallback:
             rate = Decimal(1)  # no rate available, no conversion
         rate = await apply_filters("get_rate", rate, coin, currency, fallback_currency)
@@ -6,7 +6,7 @@ from typing import Optional
 from bitcart.errors import BaseError as BitcartBaseError
 from fastapi import APIRouter, HTTPException
 
-from api import constants, settings
+from api import constants, settings, utils
 from api.logger import get_exception_message, get_logger
 from api.plugins import apply_filters
 from api.utils.common import prepare_compliant_response
@@ -29,7 +29,9 @@ async def get_supported_cryptos():
 @router.get("/rate")
 async def rate(currency: str = "btc", fiat_currency: str = "USD"):
     coin = await settings.settings.get_coin(currency)
-    rate = await apply_filters("get_rate", await coin.rate(fiat_currency.upper()), coin, fiat_currency.upper(), None)
+    rate = await apply_filters(
+        "get_rate", await utils.wallets.get_coin_rate(coin, fiat_currency.upper()), coin, fiat_currency.upper(), None
+    )
     if math.isnan(rate):
         raise HTTPException(422, "Unsupported fiat currency")
     return rate
@@ -86,5 +88,5 @@ async def get_default_rpc(currency: str):
 # SATS is useful for lightning network
 async def get_sats_rate(rate, coin, currency, fallback_currency):  # pragma: no cover
     if currency == "SATS":
-        return await coin.rate("BTC") * Decimal(10**8)
+        return await utils.wallets.get_coin_rate(coin, "BTC") * Decimal(10**8)
     return rate
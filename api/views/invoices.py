@@ -1,8 +1,8 @@
 from decimal import Decimal
-from typing import Optional
+from typing import List, Optional
 from urllib.parse import urljoin
 
-from fastapi import APIRouter, Depends, HTTPException, Response, Security
+from fastapi import APIRouter, Depends, HTTPException, Security
 from fastapi.responses import StreamingResponse
 from sqlalchemy import select
 
@@ -41,38 +41,43 @@ async def get_or_create_invoice_by_order_id(
     return item
 
 
+# POST /batch is taken by batch actions
+@router.post("/batch/create", response_model=List[schemes.InvoiceBatchResult])
+async def create_invoices_batch(
+    data: schemes.CreateInvoiceBatch,
+    user: Optional[models.User] = Security(utils.authorization.optional_auth_dependency, scopes=["invoice_management"]),
+):
+    return await crud.invoices.create_invoices_batch(data, user)
+
+
 @router.get("/export")
 async def export_invoices(
-    response: Response,
     pagination: pagination.Pagination = Depends(),
     export_format: str = "json",
     add_payments: bool = False,
     all_users: bool = False,
+    compress: bool = False,
     user: models.User = Security(utils.authorization.auth_dependency, scopes=["invoice_management"]),
 ):
     if all_users and not user.is_superuser:
         raise HTTPException(403, "Not enough permissions")
-    # always full list for export
-    pagination.limit = -1
-    pagination.offset = 0
+    if export_format not in export_ext.EXPORT_FORMATS:
+        raise HTTPException(422, f"Unsupported export format. Supported formats: {', '.join(export_ext.EXPORT_FORMATS)}")
+    # always full list for export, streamed in batches to keep memory usage constant
     query = pagination.get_base_query(models.Invoice).where(models.Invoice.status == InvoiceStatus.COMPLETE)
     if not all_users:
         query = query.where(models.Invoice.user_id == user.id)
-    data = await pagination.get_list(query)
-    await utils.database.postprocess_func(data)
-    data = list(export_ext.db_to_json(data, add_payments))
+    batches = pagination.iterate(query, postprocess=utils.database.postprocess_func)
+    content = export_ext.stream_export(batches, export_format, add_payments)
+    media_type = export_ext.EXPORT_FORMATS[export_format]
     now = utils.time.now()
     filename = now.strftime(f"bitcartcc-export-%Y%m%d-%H%M%S.{export_format}")
+    if compress:
+        content = export_ext.gzip_stream(content)
+        media_type = "application/gzip"
+        filename += ".gz"
     headers = {"Content-Disposition": f"attachment; filename={filename}"}
-    response.headers.update(headers)
-    if export_format == "json":
-        return data
-    else:
-        return StreamingResponse(
-            iter([export_ext.json_to_csv(data).getvalue()]),
-            media_type="application/csv",
-            headers=headers,
-        )
+    return StreamingResponse(content, media_type=media_type, headers=headers)
 
 
 @router.patch("/{model_id}/customer", response_model=schemes.DisplayInvoice)
@@ -184,7 +189,7 @@ async def refund_invoice(
     )
     if data.send_email and invoice.buyer_email:
         store = await utils.database.get_object(models.Store, invoice.store_id)
-        if utils.email.check_store_ping(store):
+        if await utils.email.check_store_ping(store):
             refund_url = urljoin(data.admin_host, f"/refunds/{refund.id}")
             refund.amount = currency_table.normalize(refund.currency, refund.amount)
             refund_template = await apply_filters(
@@ -242,7 +242,7 @@ async def get_syncinfo(user: models.User = Security(utils.authorization.auth_dep
 async def test_email_ping(user: models.User = Security(utils.authorization.auth_dependency, scopes=["server_management"])):
     policy = await utils.policies.get_setting(schemes.Policy)
     email_settings = policy.email_settings
-    return utils.email.check_ping(
+    return await utils.email.check_ping_async(
         email_settings.get("email_host"),
         email_settings.get("email_port"),
         email_settings.get("email_user"),
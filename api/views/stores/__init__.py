@@ -13,7 +13,7 @@ async def ping_email(
     user: models.User = Security(utils.authorization.auth_dependency, scopes=["store_management"]),
 ):
     model = await utils.database.get_object(models.Store, model_id, user)
-    return utils.email.check_ping(
+    return await utils.email.check_ping_async(
         model.email_host,
         model.email_port,
         model.email_user,
@@ -1,9 +1,9 @@
 from fastapi import APIRouter, HTTPException
 from fastapi.security import SecurityScopes
 from starlette.endpoints import WebSocketEndpoint
-from starlette.status import WS_1008_POLICY_VIOLATION
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1013_TRY_AGAIN_LATER
 
-from api import crud, models, utils
+from api import crud, models, settings, utils
 from api.ext.moneyformat import currency_table
 from api.invoices import InvoiceStatus
 
@@ -15,7 +15,7 @@ class GenericWebsocketEndpoint(WebSocketEndpoint):
     MODEL: models.db.Model
     REQUIRE_AUTH: bool = True
 
-    subscriber = None
+    subscription = None
 
     async def on_connect(self, websocket, **kwargs):
         await websocket.accept()
@@ -42,16 +42,18 @@ class GenericWebsocketEndpoint(WebSocketEndpoint):
             return
         if await self.maybe_exit_early(websocket):
             return
-        self.subscriber = await utils.redis.make_subscriber(f"{self.NAME}:{self.object_id}")
+        self.subscription = await settings.settings.websocket_broker.subscribe(f"{self.NAME}:{self.object_id}")
         utils.tasks.create_task(self.poll_subs(websocket))
 
     async def poll_subs(self, websocket):
-        async for message in utils.redis.listen_channel(self.subscriber):
-            await websocket.send_json(message)
+        async for message in self.subscription.listen():
+            await websocket.send_text(message)  # published as JSON already
+        if self.subscription.overflowed:
+            await websocket.close(code=WS_1013_TRY_AGAIN_LATER)
 
     async def on_disconnect(self, websocket, close_code):
-        if self.subscriber:
-            await self.subscriber.unsubscribe(f"channel:{self.NAME}:{self.object_id}")
+        if self.subscription:
+            settings.settings.websocket_broker.unsubscribe(self.subscription)
 
     async def maybe_exit_early(self, websocket):
         return False
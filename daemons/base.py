@@ -1,8 +1,10 @@
 import asyncio
+import contextvars
 import json
 import os
+from collections import defaultdict
 
-from aiohttp import ClientSession, WSMsgType
+from aiohttp import ClientSession, WSCloseCode, WSMsgType
 from aiohttp import __version__ as aiohttp_version
 from aiohttp import web
 from decouple import AutoConfig
@@ -13,6 +15,46 @@ LEGACY_AIOHTTP = parse_version(aiohttp_version) < parse_version("4.0.0a0")
 os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = (
     "python"  # TODO: remove when all protobufs are re-generated for version 4 in electrums
 )
+MAX_BATCH_SIZE = 100  # maximum number of JSON-RPC requests in a single batch
+# wallets resolved while processing the current batch, shared by all of its requests
+batch_wallets = contextvars.ContextVar("batch_wallets", default=None)
+WEBSOCKET_QUEUE_SIZE = 1000  # notifications buffered per websocket before the client is disconnected as too slow
+
+
+class WebsocketClient:
+    """Websocket connection with a bounded queue of serialized notifications, sent by a separate task"""
+
+    def __init__(self, ws, maxsize=WEBSOCKET_QUEUE_SIZE):
+        self.ws = ws
+        self.xpub = None
+        self.dropped = False
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.sender = asyncio.ensure_future(self.send_loop())
+
+    @property
+    def closed(self):
+        return self.dropped or self.ws.closed
+
+    def send(self, message):
+        if self.closed:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # slow consumer: disconnect it instead of buffering without bound, clients reconnect and resync
+            self.dropped = True
+            asyncio.ensure_future(self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER, message=b"Too slow"))
+
+    async def send_loop(self):
+        while not self.closed:
+            message = await self.queue.get()
+            try:
+                await self.ws.send_str(message)
+            except ConnectionResetError:
+                break
+
+    def close(self):
+        self.sender.cancel()
 
 
 class BaseDaemon:
@@ -55,6 +97,7 @@ class BaseDaemon:
             custom_spec = load_spec(custom_spec_file, exit_on_error=False)
             maybe_update_key(self.spec, custom_spec, "electrum_map")
             maybe_update_key(self.spec, custom_spec, "exceptions")
+        self.spec["batch"] = {"max_size": MAX_BATCH_SIZE}
 
     def get_error_code(self, error, fallback_code=-32603):
         """Get jsonrpc error code returned to client
@@ -83,43 +126,107 @@ class BaseDaemon:
         if isinstance(xpub, dict):
             return xpub.pop("xpub", None), xpub.pop("contract", None), xpub
 
-    async def get_handle_request_params(self, request):
+    async def read_request_data(self, request):
         try:
-            data = await (request.json() if LEGACY_AIOHTTP else request.json(content_type=None))
+            return await (request.json() if LEGACY_AIOHTTP else request.json(content_type=None)), None
         except json.decoder.JSONDecodeError:
-            return None, None, None, None, None, None, None, JsonResponse(code=-32700, error="Parse error")
+            return None, JsonResponse(code=-32700, error="Parse error")
+
+    def get_request_params(self, data):
+        if not isinstance(data, dict):
+            return None, None, None, None, None, None, None, JsonResponse(code=-32600, error="Invalid Request")
         method, id, params = data.get("method"), data.get("id", None), data.get("params", [])
         error = None if method else JsonResponse(code=-32601, error="Procedure not found", id=id)
         args, kwargs = parse_params(params)
         xpub, contract, extra_params = self.parse_xpub(kwargs.pop("xpub", None))
         return id, method, xpub, contract, extra_params, args, kwargs, error
 
+    async def get_handle_request_params(self, request):
+        data, error = await self.read_request_data(request)
+        if error:
+            return None, None, None, None, None, None, None, error
+        return self.get_request_params(data)
+
+    async def process_request(self, data):
+        id, req_method, xpub, contract, extra_params, req_args, req_kwargs, error = self.get_request_params(data)
+        if error:
+            return error.send()
+        return await self.execute_method(id, req_method, xpub, contract, extra_params, req_args, req_kwargs)
+
+    async def process_batch(self, data):
+        """Process JSON-RPC 2.0 batch: requests are executed concurrently, wallets are loaded once per batch
+
+        Requests without id are notifications, their responses are not returned
+        """
+        if not data:
+            return JsonResponse(code=-32600, error="Invalid Request").send()
+        if len(data) > MAX_BATCH_SIZE:
+            return JsonResponse(code=-32600, error=f"Batch too large, maximum size is {MAX_BATCH_SIZE}").send()
+        batch_wallets.set({})
+        responses = await asyncio.gather(*(self.process_request(item) for item in data))
+        result = [
+            json.loads(response.text) for item, response in zip(data, responses) if not isinstance(item, dict) or "id" in item
+        ]
+        if not result:
+            return web.Response()
+        return web.json_response(result)
+
+    async def resolve_wallet(self, key, load_func):
+        """Load wallet, sharing the result between requests of the current batch
+
+        Args:
+            key (tuple): hashable key identifying the wallet
+            load_func (Callable): coroutine function loading the wallet
+
+        Returns:
+            Any: load_func result
+        """
+        wallets = batch_wallets.get()
+        if wallets is None:
+            return await load_func()
+        if key not in wallets:
+            wallets[key] = asyncio.ensure_future(load_func())
+        return await asyncio.shield(wallets[key])
+
     @authenticate
     async def handle_request(self, request):
-        id, req_method, xpub, contract, extra_params, req_args, req_kwargs, error = await self.get_handle_request_params(
-            request
-        )
+        data, error = await self.read_request_data(request)
         if error:
             return error.send()
-        return await self.execute_method(id, req_method, xpub, contract, extra_params, req_args, req_kwargs)
+        if isinstance(data, list):
+            return await self.process_batch(data)
+        return await self.process_request(data)
+
+    def subscribe_websocket(self, client, xpub):
+        subscriptions = self.app["websocket_subscriptions"]
+        subscriptions[client.xpub].discard(client)
+        if not subscriptions[client.xpub]:
+            del subscriptions[client.xpub]
+        client.xpub = xpub
+        if not client.closed:
+            subscriptions[xpub].add(client)
 
     @authenticate
     async def handle_websocket(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        ws.config = {"xpub": None}
-        request.app["websockets"].add(ws)
+        client = WebsocketClient(ws)
+        request.app["websockets"].add(client)
+        request.app["websocket_subscriptions"][None].add(client)
         try:
             async for msg in ws:
                 if msg.type == WSMsgType.TEXT:
                     try:
                         data = msg.json()
                         if data.get("xpub"):
-                            ws.config["xpub"] = data["xpub"]
+                            self.subscribe_websocket(client, data["xpub"])
                     except json.JSONDecodeError:
                         pass
         finally:
-            request.app["websockets"].remove(ws)
+            request.app["websockets"].remove(client)
+            self.subscribe_websocket(client, None)
+            request.app["websocket_subscriptions"][None].discard(client)
+            client.close()
 
     @authenticate
     async def handle_spec(self, request):
@@ -127,6 +234,7 @@ class BaseDaemon:
 
     def configure_app(self):
         self.app["websockets"] = set()
+        self.app["websocket_subscriptions"] = defaultdict(set)  # xpub (None if subscribed to all wallets) -> clients
         self.app.router.add_post("/", self.handle_request)
         self.app.router.add_get("/ws", self.handle_websocket)
         self.app.router.add_get("/spec", self.handle_spec)
@@ -142,13 +250,15 @@ class BaseDaemon:
         return {"updates": [data], "wallet": xpub, "currency": self.name}
 
     async def notify_websockets(self, data, xpub, notify_all=False):
-        notification = self.build_notification(data, xpub)
-        coros = [
-            ws.send_json(notification)
-            for ws in self.app["websockets"]
-            if not ws.closed and ((notify_all and not ws.config["xpub"]) or ws.config["xpub"] == xpub)
-        ]
-        await asyncio.gather(*coros)
+        subscriptions = self.app["websocket_subscriptions"]
+        clients = subscriptions.get(xpub, set())
+        if notify_all and xpub is not None:
+            clients = clients | subscriptions.get(None, set())
+        if not clients:
+            return True
+        notification = json.dumps(self.build_notification(data, xpub))  # serialized once for all clients
+        for client in clients:
+            client.send(notification)
         return True
 
     ### Overridable methods for completely custom coins ###
@@ -166,6 +276,7 @@ class BaseDaemon:
         self.VERBOSE = self.env("DEBUG", cast=bool, default=False)
         self.NET = self.env("NETWORK", default="mainnet")
         self.DEFAULT_CURRENCY = self.env("FIAT_CURRENCY", default="USD")
+        self.UPDATES_BUFFER_SIZE = self.env("UPDATES_BUFFER_SIZE", cast=int, default=1000)
 
     async def on_startup(self, app):
         """Create essential objects for daemon operation here
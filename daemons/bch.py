@@ -15,6 +15,7 @@ class BCHDaemon(BTCDaemon):
         "verified2": "verified_tx",
     }
     ALIASES = {"get_request": "getrequest"}
+    ADD_REQUEST_METHOD = "addrequest"
 
     def load_electrum(self):
         import electroncash
@@ -150,6 +151,9 @@ class BCHDaemon(BTCDaemon):
         )
         return result
 
+    def get_tx_confirmations(self, wallet, tx_hash):
+        return self.wallets[wallet]["wallet"].get_tx_height(tx_hash)[1]
+
     @rpc
     def recommended_fee(self, target, wallet=None) -> float:  # no fee estimation for BCH
         return 0
@@ -13,11 +13,13 @@ from urllib.parse import urlparse
 from base import BaseDaemon
 from utils import (
     JsonResponse,
+    UpdatesBuffer,
     async_partial,
     cached,
     format_satoshis,
     get_exception_message,
     get_function_header,
+    get_updates_stats,
     hide_logging_errors,
     modify_payment_url,
     rpc,
@@ -44,6 +46,7 @@ class BTCDaemon(BaseDaemon):
         "verified": "verified_tx",
     }
     ALIASES = {"getrequest": "get_request"}
+    ADD_REQUEST_METHOD = "add_request"  # electrum command creating payment requests, used by add_requests
     # override if your daemon has different networks than default electrum provides
     NETWORK_MAPPING: dict = {}
 
@@ -231,7 +234,7 @@ class BTCDaemon(BaseDaemon):
         self.init_wallet(wallet)
         self.load_cmd_wallet(command_runner, wallet)
         self.wallets[xpub] = {"wallet": wallet, "cmd": command_runner}
-        self.wallets_updates[xpub] = []
+        self.wallets_updates[xpub] = UpdatesBuffer(self.UPDATES_BUFFER_SIZE)
         return wallet, command_runner
 
     def add_wallet_to_command(self, wallet, req_method, exec_method, **kwargs):
@@ -250,7 +253,9 @@ class BTCDaemon(BaseDaemon):
     async def _get_wallet(self, id, req_method, xpub, diskless=False):
         wallet = cmd = error = None
         try:
-            wallet, cmd = await self.load_wallet(xpub, config=self.electrum_config, diskless=diskless)
+            wallet, cmd = await self.resolve_wallet(
+                (xpub, diskless), lambda: self.load_wallet(xpub, config=self.electrum_config, diskless=diskless)
+            )
             while self.is_still_syncing(wallet):
                 await asyncio.sleep(0.1)
         except Exception as e:
@@ -440,15 +445,73 @@ class BTCDaemon(BaseDaemon):
         )
         return result
 
+    @rpc(requires_wallet=True)
+    async def get_requests(self, keys, wallet):
+        get_request = self.supported_methods["get_request"]
+        results = {}
+        for key in keys:
+            try:
+                result = get_request(key, wallet=wallet)
+                results[key] = await result if inspect.isawaitable(result) else result
+            except Exception:
+                results[key] = None
+        return results
+
+    @rpc(requires_wallet=True)
+    async def add_requests(self, requests, wallet):
+        # each request takes the path of a single call, so command name, aliases and wallet binding of the coin apply
+        wallet_data = self.wallets[wallet]
+        exec_method, custom, error = await self.get_exec_method(wallet_data["cmd"], None, self.ADD_REQUEST_METHOD)
+        if error:
+            raise Exception(f"{self.ADD_REQUEST_METHOD} is not supported")
+        results = []
+        for request in requests:
+            try:
+                results.append(
+                    await self.get_exec_result(
+                        wallet,
+                        self.ADD_REQUEST_METHOD,
+                        [],
+                        request,
+                        exec_method,
+                        custom,
+                        wallet=wallet_data["wallet"],
+                        config=self.electrum_config,
+                    )
+                )
+            except Exception as e:
+                results.append({"error": self.get_exception_message(e)})
+        return results
+
+    def get_tx_confirmations(self, wallet, tx_hash):
+        return self.wallets[wallet]["wallet"].adb.get_tx_height(tx_hash).conf
+
+    @rpc(requires_wallet=True)
+    async def get_confirmations(self, keys, wallet):
+        # the custom get_request method, getrequest is only registered as its alias in BTC
+        get_request = self.supported_methods["get_request"]
+        results = {}
+        for key in keys:
+            try:
+                result = get_request(key, wallet=wallet)
+                result = await result if inspect.isawaitable(result) else result
+                results[key] = result.get("confirmations", 0)
+            except Exception:  # not a payment request, assume it is a transaction hash
+                try:
+                    results[key] = self.get_tx_confirmations(wallet, key)
+                except Exception:
+                    results[key] = None
+        return results
+
     @rpc
     def validatekey(self, key, wallet=None):
         return self.electrum.keystore.is_master_key(key) or self.electrum.keystore.is_seed(key)
 
     @rpc(requires_wallet=True)
-    def get_updates(self, wallet):
-        updates = self.wallets_updates[wallet]
-        self.wallets_updates[wallet] = []
-        return updates
+    def get_updates(self, since=None, wallet=None):
+        if since is None:
+            return self.wallets_updates[wallet].read()
+        return self.wallets_updates[wallet].get_since(since)
 
     async def _verify_transaction(self, tx_hash, tx_height):
         merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
@@ -569,6 +632,7 @@ class BTCDaemon(BaseDaemon):
     async def getinfo(self, wallet=None):
         data = await self.create_commands(config=self.electrum_config).getinfo()
         data["synchronized"] = not self.is_still_syncing()
+        data["updates_buffer"] = get_updates_stats(self.wallets_updates.values())
         return data
 
     @rpc(requires_wallet=True, requires_network=True)
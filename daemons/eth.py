@@ -17,7 +17,15 @@ from hexbytes import HexBytes
 from mnemonic import Mnemonic
 from storage import JSONEncoder as StorageJSONEncoder
 from storage import Storage
-from utils import exception_retry_middleware, load_json_dict, modify_payment_url, rpc, try_cast_num
+from utils import (
+    UpdatesBuffer,
+    exception_retry_middleware,
+    get_scan_heights,
+    load_json_dict,
+    modify_payment_url,
+    rpc,
+    try_cast_num,
+)
 from web3 import Web3
 from web3.contract import AsyncContract
 from web3.datastructures import AttributeDict
@@ -35,6 +43,8 @@ FEE_PARAMS = EIP1559_PARAMS + ("gasPrice", "gas")
 
 TX_DEFAULT_GAS = 21000
 
+TRANSFER_TOPIC = Web3.keccak(text="Transfer(address,address,uint256)").hex()
+
 
 class JSONEncoder(StorageJSONEncoder):
     def default(self, obj):
@@ -265,31 +275,68 @@ class ETHDaemon(BlockProcessorDaemon):
     def __init__(self):
         super().__init__()
         self.contracts = {}
+        self.contract_divisibilities = {}
         self.contract_heights = self.config.get_dict("contract_heights")
+        self.contracts_task = None
         self.contract_cache = {"decimals": {}, "symbol": {}}
 
+    async def process_transfer_log(self, tx_data, contract, divisibility):
+        try:
+            tx = Transaction(
+                str(tx_data["transactionHash"].hex()),
+                tx_data["args"]["from"],
+                tx_data["args"]["to"],
+                tx_data["args"]["value"],
+                contract,
+                divisibility,
+            )
+            await self.process_transaction(tx)
+        except Exception:
+            if self.VERBOSE:
+                print(f"Error processing transaction {tx_data['transactionHash'].hex()}:")
+                print(traceback.format_exc())
+
     async def check_contract_logs(self, contract, divisibility, from_block=None, to_block=None):
         try:
             for tx_data in await contract.events.Transfer.get_logs(fromBlock=from_block, toBlock=to_block):
-                try:
-                    tx = Transaction(
-                        str(tx_data["transactionHash"].hex()),
-                        tx_data["args"]["from"],
-                        tx_data["args"]["to"],
-                        tx_data["args"]["value"],
-                        contract.address,
-                        divisibility,
-                    )
-                    await self.process_transaction(tx)
-                except Exception:
-                    if self.VERBOSE:
-                        print(f"Error processing transaction {tx_data['transactionHash'].hex()}:")
-                        print(traceback.format_exc())
+                await self.process_transfer_log(tx_data, contract.address, divisibility)
         except Exception:
             if self.VERBOSE:
                 print(f"Error getting logs on contract {contract.address}:")
                 print(traceback.format_exc())
 
+    def get_transfer_filter(self, contracts, from_block, to_block):
+        # only transfers to our wallets are fetched: recipient is the second indexed argument
+        recipients = ["0x" + address[2:].lower().rjust(64, "0") for address in self.addresses]
+        return {
+            "fromBlock": from_block,
+            "toBlock": to_block,
+            "address": contracts,
+            "topics": [TRANSFER_TOPIC, None, recipients],
+        }
+
+    async def check_all_contract_logs(self, contracts, current_height):
+        if not self.addresses:
+            return
+        # contracts lagging behind (i.e. added with a stale persisted height) only scan their last MAX_SYNC_BLOCKS
+        # blocks, so they never shorten the range of up-to-date ones, which all advance to current_height afterwards
+        heights = get_scan_heights(
+            {contract: self.contract_heights[contract] for contract in contracts}, current_height, self.MAX_SYNC_BLOCKS
+        )
+        from_block = min(heights.values()) + 1
+        for log in await self.coin.web3.eth.get_logs(self.get_transfer_filter(contracts, from_block, current_height)):
+            contract = self.coin.normalize_address(log["address"])
+            if contract not in heights or log["blockNumber"] <= heights[contract]:  # already scanned for this contract
+                continue
+            try:
+                tx_data = self.contracts[contract].events.Transfer().process_log(log)
+            except Exception:
+                if self.VERBOSE:
+                    print(f"Error decoding transfer log {log['transactionHash'].hex()}:")
+                    print(traceback.format_exc())
+                continue
+            await self.process_transfer_log(tx_data, contract, self.contract_divisibilities[contract])
+
     def create_coin(self):
         self.coin = ETHFeatures(
             Web3(
@@ -318,8 +365,9 @@ class ETHDaemon(BlockProcessorDaemon):
 
     async def start_contract_listening(self, contract):
         contract_obj = await self.create_web3_contract(contract)
-        divisibility = await self.readcontract(contract_obj, "decimals")
-        self.loop.create_task(self.check_contracts(contract_obj, divisibility))
+        self.contract_divisibilities[contract] = await self.readcontract(contract_obj, "decimals")
+        if self.contracts_task is None:
+            self.contracts_task = self.loop.create_task(self.check_contracts())
         return contract_obj
 
     async def create_web3_contract(self, contract):
@@ -328,18 +376,16 @@ class ETHDaemon(BlockProcessorDaemon):
         except Exception as e:
             raise Exception("Invalid contract address or non-ERC20 token") from e
 
-    async def check_contracts(self, contract, divisibility):
+    async def check_contracts(self):
+        # one eth_getLogs call per iteration covers all the contracts, each of them keeps its own height checkpoint
         while self.running:
             try:
                 current_height = await self.coin.get_block_number()
-                if current_height > self.contract_heights[contract.address]:
-                    await self.check_contract_logs(
-                        contract,
-                        divisibility,
-                        from_block=self.contract_heights[contract.address] + 1,
-                        to_block=min(self.contract_heights[contract.address] + self.MAX_SYNC_BLOCKS, current_height),
-                    )
-                    self.contract_heights[contract.address] = current_height
+                contracts = [contract for contract in self.contracts if current_height > self.contract_heights[contract]]
+                if contracts:
+                    await self.check_all_contract_logs(contracts, current_height)
+                    for contract in contracts:
+                        self.contract_heights[contract] = current_height
             except Exception:
                 if self.VERBOSE:
                     print("Error processing contract logs:")
@@ -365,7 +411,7 @@ class ETHDaemon(BlockProcessorDaemon):
             db = WalletDB(storage.read())
             wallet = Wallet(self.coin, db, storage)
         self.wallets[wallet_key] = wallet
-        self.wallets_updates[wallet_key] = []
+        self.wallets_updates[wallet_key] = UpdatesBuffer(self.UPDATES_BUFFER_SIZE)
         self.addresses[wallet.address].add(wallet_key)
         await self.add_contract(contract, wallet_key)
         await wallet.start(self.latest_blocks.copy())
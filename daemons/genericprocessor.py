@@ -18,7 +18,15 @@ from storage import JSONEncoder as StorageJSONEncoder
 from storage import Storage, StoredDBProperty, StoredObject, StoredProperty
 from storage import WalletDB as StorageWalletDB
 from storage import decimal_to_string
-from utils import CastingDataclass, JsonResponse, get_exception_message, get_function_header, hide_logging_errors, rpc
+from utils import (
+    CastingDataclass,
+    JsonResponse,
+    get_exception_message,
+    get_function_header,
+    get_updates_stats,
+    hide_logging_errors,
+    rpc,
+)
 
 NO_HISTORY_MESSAGE = "We don't access transaction history to remain lightweight"
 WRITE_DOWN_SEED_MESSAGE = "Please keep your seed in a safe place; if you lose it, you will not be able to restore your wallet."
@@ -300,10 +308,35 @@ class Wallet:
         self.running = False
         self.loop = asyncio.get_event_loop()
         self.synchronized = False
+        self._save_handle = None
+        self._compaction = None
 
-    def save_db(self):
-        if self.storage:
-            self.db.write(self.storage)
+    def save_db(self, now=False):
+        # changes are journaled once per WALLET_SAVE_DELAY window instead of on every modification
+        # changes which must survive a crash right after the reply are written immediately instead
+        if not self.storage:
+            return
+        delay = daemon_ctx.get().WALLET_SAVE_DELAY
+        if now or delay <= 0 or not self.storage.file_exists():
+            return self.flush_db()
+        if self._save_handle is None:
+            self._save_handle = self.loop.call_later(delay, self.flush_db)
+
+    def flush_db(self):
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        self.db.write(self.storage)
+        if self._compaction is None and self.storage.needs_compaction():
+            args = self.db.prepare_compaction(self.storage)
+            self._compaction = self.loop.run_in_executor(None, self.storage.compact, *args)
+            self._compaction.add_done_callback(self._on_compaction_done)
+
+    def _on_compaction_done(self, future):
+        self._compaction = None
+        if not future.cancelled() and future.exception() is not None and daemon_ctx.get().VERBOSE:
+            print(f"Error compacting wallet {self.storage.path}:")
+            print(get_exception_traceback(future.exception()))
 
     async def _start_init_vars(self):
         if self.latest_height == -1:
@@ -362,6 +395,8 @@ class Wallet:
     def stop(self, block_number):
         self.running = False
         self.latest_height = block_number
+        if self.storage:
+            self.flush_db()
 
     async def make_payment_request(self, address, amount, message, expiration):
         amount = amount or Decimal()
@@ -508,6 +543,87 @@ class Wallet:
                 print(traceback.format_exc())
 
 
+class BlockPipeline:
+    """Catches up with the chain: blocks are fetched ahead into a bounded queue and processed concurrently
+
+    Progress is committed to latest_height in order once per chunk, so a restart never skips a block which wasn't processed yet
+    """
+
+    def __init__(self, daemon):
+        self.daemon = daemon
+        self.queue = None
+        self.blocks_processed = 0
+        self.run_processed = 0
+        self.run_started = None
+        self.run_elapsed = 0
+        self.next_height = None
+        self.done = set()
+
+    async def fetch_worker(self, heights):
+        for block_number in heights:
+            try:
+                block = await self.daemon.coin.get_block_txes(block_number)
+            except Exception:
+                block = None
+                if self.daemon.VERBOSE:
+                    print(f"Error fetching block {block_number}:")
+                    print(traceback.format_exc())
+            await self.queue.put((block_number, block))
+
+    async def process_worker(self):
+        while True:
+            block_number, block = await self.queue.get()
+            try:
+                if block is not None:
+                    await self.daemon.process_block(block_number, block)
+            finally:
+                self.commit(block_number)
+                self.queue.task_done()
+
+    def commit(self, block_number):
+        self.blocks_processed += 1
+        self.run_processed += 1
+        self.done.add(block_number)
+        committed = False
+        while self.next_height in self.done:
+            self.done.remove(self.next_height)
+            self.next_height += 1
+            committed = committed or self.next_height % CHUNK_SIZE == 0
+        if committed:  # persist progress once per chunk
+            self.daemon.latest_height = self.next_height - 1
+
+    async def run(self, start_height, end_height):
+        if start_height > end_height:
+            return
+        self.queue = asyncio.Queue(maxsize=self.daemon.BLOCK_PREFETCH_SIZE)
+        self.next_height = start_height
+        self.done = set()
+        self.run_processed = 0
+        self.run_started = time.monotonic()
+        heights = iter(range(start_height, end_height + 1))  # shared by fetchers, each height is fetched once
+        processors = [asyncio.ensure_future(self.process_worker()) for _ in range(self.daemon.BLOCK_PROCESS_CONCURRENCY)]
+        try:
+            await asyncio.gather(*(self.fetch_worker(heights) for _ in range(self.daemon.BLOCK_FETCH_CONCURRENCY)))
+            await self.queue.join()
+        finally:
+            for task in processors:
+                task.cancel()
+            await asyncio.gather(*processors, return_exceptions=True)
+            self.run_elapsed = time.monotonic() - self.run_started
+            self.run_started = None
+            self.queue = None
+
+    @property
+    def stats(self):
+        elapsed = time.monotonic() - self.run_started if self.run_started is not None else self.run_elapsed
+        return {
+            "blocks_processed": self.blocks_processed,
+            "blocks_per_second": round(self.run_processed / elapsed, 2) if elapsed else 0,
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "queue_size": self.daemon.BLOCK_PREFETCH_SIZE,
+        }
+
+
 class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
     name: str
     BASE_SPEC_FILE: str
@@ -552,6 +668,7 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             self.CONTRACT_FIAT_NAME = self.FIAT_NAME
         self.exchange_rates = defaultdict(dict)
         self.latest_blocks = deque(maxlen=self.MAX_SYNC_BLOCKS)
+        self.block_pipeline = BlockPipeline(self)
         self.config_path = os.path.join(self.get_datadir(), "config")
         self.config = ConfigDB(self.config_path)
         self.create_coin()
@@ -579,6 +696,10 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         self.MAX_SYNC_BLOCKS = max_sync_hours * self.DEFAULT_MAX_SYNC_BLOCKS
         self.NO_SYNC_WAIT = self.env("EXPERIMENTAL_NOSYNC", cast=bool, default=False)
         self.TX_SPEED = self.env("TX_SPEED", cast=str, default="network").lower()
+        self.WALLET_SAVE_DELAY = self.env("WALLET_SAVE_DELAY", cast=float, default=1)
+        self.BLOCK_FETCH_CONCURRENCY = self.env("BLOCK_FETCH_CONCURRENCY", cast=int, default=10)
+        self.BLOCK_PROCESS_CONCURRENCY = self.env("BLOCK_PROCESS_CONCURRENCY", cast=int, default=4)
+        self.BLOCK_PREFETCH_SIZE = self.env("BLOCK_PREFETCH_SIZE", cast=int, default=50)
         if self.TX_SPEED not in self.SPEED_MULTIPLIERS:
             raise ValueError(f"Invalid TX_SPEED: {self.TX_SPEED}. Valid values: {', '.join(self.SPEED_MULTIPLIERS.keys())}")
 
@@ -661,41 +782,31 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
                     print(f"Error processing transaction {self.coin.get_tx_hash(tx_data)}:")
                     print(traceback.format_exc())
 
-    async def process_block(self, start_height, end_height):
-        for block_number in range(start_height, end_height + 1):
-            try:
-                await self.trigger_event({"event": "new_block", "height": block_number}, None)
-                block = await self.coin.get_block_txes(block_number)
-                transactions = []
-                tasks = []
-                semaphore = asyncio.Semaphore(20)
-                for tx_data in block:
-                    tasks.append(self.process_tx_task(tx_data, semaphore))
-                results = await asyncio.gather(*tasks)
-                for res in results:
-                    if res is not None:
-                        transactions.append(res)
-                self.latest_blocks.append(transactions)
-            except Exception:
-                if self.VERBOSE:
-                    print(f"Error processing block {block_number}:")
-                    print(traceback.format_exc())
+    async def process_block(self, block_number, block):
+        try:
+            await self.trigger_event({"event": "new_block", "height": block_number}, None)
+            transactions = []
+            tasks = []
+            semaphore = asyncio.Semaphore(20)
+            for tx_data in block:
+                tasks.append(self.process_tx_task(tx_data, semaphore))
+            results = await asyncio.gather(*tasks)
+            for res in results:
+                if res is not None:
+                    transactions.append(res)
+            self.latest_blocks.append(transactions)
+        except Exception:
+            if self.VERBOSE:
+                print(f"Error processing block {block_number}:")
+                print(traceback.format_exc())
 
     async def process_pending(self):
         while self.running:
             try:
                 current_height = await self.coin.get_block_number()
-                tasks = []
-                # process at max 300 blocks since last processed block, fetched by chunks
-                for block_number in range(
-                    self.latest_height + 1, min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height) + 1, CHUNK_SIZE
-                ):
-                    tasks.append(self.process_block(block_number, min(block_number + CHUNK_SIZE - 1, current_height)))
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-                if self.VERBOSE:
-                    for task in results:
-                        if isinstance(task, Exception):
-                            print(get_exception_traceback(task))
+                # process at max 300 blocks since last processed block
+                end_height = min(self.latest_height + self.MAX_SYNC_BLOCKS, current_height)
+                await self.block_pipeline.run(self.latest_height + 1, end_height)
                 self.latest_height = current_height
                 self.synchronized = True  # set it once, as we just need to ensure initial sync was done
             except Exception:
@@ -760,7 +871,10 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             if not self.NO_SYNC_WAIT:
                 while not should_skip and not self.synchronized:  # wait for initial sync to fetch blocks
                     await asyncio.sleep(0.1)
-            wallet = await self.load_wallet(xpub, contract, diskless=diskless, extra_params=extra_params)
+            wallet = await self.resolve_wallet(
+                (xpub, contract, diskless, json.dumps(extra_params, sort_keys=True, default=str)),
+                lambda: self.load_wallet(xpub, contract, diskless=diskless, extra_params=extra_params),
+            )
             if should_skip:
                 return wallet, error
             if not self.NO_SYNC_WAIT:
@@ -822,13 +936,19 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
 
     @rpc(requires_wallet=True, requires_network=True)
     async def add_request(self, amount, memo="", expiration=3600, force=False, wallet=None):
+        req = await self._add_request(wallet, amount, memo, expiration)
+        # the API stores the request as soon as it gets it, so it is journaled before replying
+        self.wallets[wallet].save_db(now=True)
+        return await self.wallets[wallet].export_request(req)
+
+    async def _add_request(self, wallet, amount, memo="", expiration=3600, force=False):
         amount = Decimal(amount)
         addr = self.wallets[wallet].address
         expiration = int(expiration) if expiration else None
         req = await self.wallets[wallet].make_payment_request(addr, amount, memo, expiration)
-        self.wallets[wallet].add_payment_request(req)
+        self.wallets[wallet].add_payment_request(req, save_db=False)
         self.loop.create_task(self.wallets[wallet].expired_task(req))
-        return await self.wallets[wallet].export_request(req)
+        return req
 
     @rpc(requires_network=True)
     @abstractmethod
@@ -879,6 +999,30 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             currency = self.DEFAULT_CURRENCY
         return str(self.exchange_rates[origin_currency].get(currency, Decimal("NaN")))
 
+    async def _get_tx_confirmations(self, tx_hash, semaphore):
+        async with semaphore:
+            try:
+                return await self.coin.get_confirmations(tx_hash)
+            except Exception:
+                if self.VERBOSE:
+                    print(f"Error getting confirmations of {tx_hash}:")
+                    print(traceback.format_exc())
+
+    @rpc(requires_wallet=True, requires_network=True)
+    async def get_confirmations(self, keys, wallet):
+        tx_hashes = {}
+        for key in keys:
+            req = self.wallets[wallet].get_request(key)
+            if req is None:  # not a payment request, assume it is a transaction hash
+                tx_hashes[key] = key
+            elif req.tx_hashes:
+                tx_hashes[key] = req.tx_hashes[0]
+        unique_hashes = list(set(tx_hashes.values()))
+        semaphore = asyncio.Semaphore(20)
+        results = await asyncio.gather(*(self._get_tx_confirmations(tx_hash, semaphore) for tx_hash in unique_hashes))
+        confirmations = dict(zip(unique_hashes, results))
+        return {key: confirmations[tx_hashes[key]] if key in tx_hashes else 0 for key in keys}
+
     @rpc(requires_network=True)
     @abstractmethod
     async def get_default_fee(self, tx, wallet=None):
@@ -901,10 +1045,10 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
         return data
 
     @rpc(requires_wallet=True, requires_network=True)
-    def get_updates(self, wallet):
-        updates = self.wallets_updates[wallet]
-        self.wallets_updates[wallet] = []
-        return updates
+    def get_updates(self, since=None, wallet=None):
+        if since is None:
+            return self.wallets_updates[wallet].read()
+        return self.wallets_updates[wallet].get_since(since)
 
     @rpc(requires_network=True)
     @abstractmethod
@@ -957,6 +1101,8 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
             "spv_nodes": nodes,
             "synchronized": not await self.coin.is_syncing() and self.synchronized,
             "version": self.VERSION,
+            "block_pipeline": self.block_pipeline.stats,
+            "updates_buffer": get_updates_stats(self.wallets_updates.values()),
         }
 
     @rpc
@@ -981,6 +1127,31 @@ class BlockProcessorDaemon(BaseDaemon, metaclass=ABCMeta):
     def getpubkeys(self, *args, wallet=None):
         return self.wallets[wallet].keystore.public_key
 
+    async def _export_request(self, wallet, key, semaphore):
+        async with semaphore:
+            req = self.wallets[wallet].get_request(key)
+            if not req:
+                return None
+            return await self.wallets[wallet].export_request(req)
+
+    @rpc(requires_wallet=True, requires_network=True)
+    async def get_requests(self, keys, wallet):
+        semaphore = asyncio.Semaphore(20)
+        results = await asyncio.gather(*(self._export_request(wallet, key, semaphore) for key in keys))
+        return dict(zip(keys, results))
+
+    @rpc(requires_wallet=True, requires_network=True)
+    async def add_requests(self, requests, wallet):
+        created = []
+        for request in requests:
+            try:
+                created.append(await self._add_request(wallet, **request))
+            except Exception as e:
+                created.append({"error": get_exception_message(e)})
+        # one journal write for the whole batch, before replying
+        self.wallets[wallet].save_db(now=True)
+        return [req if isinstance(req, dict) else await self.wallets[wallet].export_request(req) for req in created]
+
     @rpc(requires_wallet=True, requires_network=True)
     async def getrequest(self, key, wallet):
         req = self.wallets[wallet].get_request(key)
@@ -1,4 +1,5 @@
 # Thanks to https://github.com/spesmilo/electrum storage implementation
+import contextlib
 import copy
 import json
 import os
@@ -31,30 +32,108 @@ class JSONEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+JOURNAL_COMPACT_MIN_SIZE = 1024 * 1024  # journal is compacted once it outgrows both this and the snapshot
+
+
+def apply_journal_record(data, record):
+    *parents, key = record["path"]
+    deleted = record.get("deleted", False)
+    for parent in parents:
+        if not isinstance(data.get(parent), dict):
+            if deleted:
+                return
+            data[parent] = {}
+        data = data[parent]
+    if deleted:
+        data.pop(key, None)
+    else:
+        data[key] = record["value"]
+
+
 class Storage:
+    """Wallet file: a JSON snapshot plus an append-only journal of changes made since it was written
+
+    Journal (<path>.log) contains one JSON record per line, either {"path": [...], "value": ...} or
+    {"path": [...], "deleted": true}. Records are replayed on top of the snapshot on load, so files written
+    without a journal load as before
+    """
+
     def __init__(self, path, in_memory_only=False):
         self.path = standardize_path(path)
+        self.log_path = f"{self.path}.log" if self.path else None
         self._file_exists = in_memory_only or bool(self.path and os.path.exists(self.path))
         self._in_memory_only = in_memory_only
+        self.file_lock = threading.RLock()
+        self.generation = 0
+        self.snapshot_size = 0
+        self.log_size = 0
         if self.file_exists() and not self._in_memory_only:
             with open(self.path, encoding="utf-8") as f:
                 self.raw = f.read()
+            self.snapshot_size = len(self.raw)
+            self.raw = self.replay_journal(self.raw)
         else:
             self.raw = ""
 
     def read(self):
         return self.raw
 
-    def write(self, data: str) -> None:
-        if self._in_memory_only:
+    def read_journal(self):
+        try:
+            with open(self.log_path, "rb") as f:
+                journal = f.read()
+        except FileNotFoundError:
+            return []
+        records = []
+        valid_size = 0
+        *lines, _ = journal.split(b"\n")
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            valid_size += len(line) + 1
+        if valid_size < len(journal):  # drop the record torn by a crash, so that new ones are appended cleanly
+            with open(self.log_path, "r+b") as f:
+                f.truncate(valid_size)
+                os.fsync(f.fileno())
+        self.log_size = valid_size
+        return records
+
+    def replay_journal(self, raw):
+        records = self.read_journal()
+        if not records:
+            return raw
+        try:
+            data = json.loads(raw)
+        except ValueError:  # reported by the db
+            return raw
+        for record in records:
+            apply_journal_record(data, record)
+        return json.dumps(data)
+
+    def append(self, lines) -> None:
+        if self._in_memory_only or not lines:
             return
-        # write in temporary first to not corrupt the main file
-        s = data
-        temp_path = f"{self.path}.tmp.{os.getpid()}"
+        data = "".join(f"{line}\n" for line in lines).encode("utf-8")
+        with self.file_lock:
+            fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, stat.S_IREAD | stat.S_IWRITE)
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_size += len(data)
+
+    def needs_compaction(self) -> bool:
+        return self.log_size > max(JOURNAL_COMPACT_MIN_SIZE, self.snapshot_size)
+
+    def _write_temp(self, temp_path, data):
         with open(temp_path, "w", encoding="utf-8") as f:
-            f.write(s)
+            f.write(data)
             f.flush()
             os.fsync(f.fileno())
+
+    def _replace(self, temp_path, size):
         try:
             mode = os.stat(self.path).st_mode
         except FileNotFoundError:
@@ -64,6 +143,51 @@ class Storage:
         os.replace(temp_path, self.path)
         os.chmod(self.path, mode)
         self._file_exists = True
+        self.snapshot_size = size
+        self.generation += 1
+
+    def trim_journal(self, offset):
+        # records before offset are covered by the snapshot. If we crash before trimming, replaying them is a no-op
+        if offset >= self.log_size:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.log_path)
+            self.log_size = 0
+            return
+        with open(self.log_path, "rb") as f:
+            f.seek(offset)
+            tail = f.read()
+        temp_path = f"{self.log_path}.tmp.{os.getpid()}"
+        with open(temp_path, "wb") as f:
+            f.write(tail)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.log_path)
+        self.log_size = len(tail)
+
+    def write(self, data: str) -> None:
+        if self._in_memory_only:
+            return
+        # write in temporary first to not corrupt the main file
+        with self.file_lock:
+            self._write_temp(f"{self.path}.tmp.{os.getpid()}", data)
+            self._replace(f"{self.path}.tmp.{os.getpid()}", len(data))
+            self.trim_journal(self.log_size)
+
+    def compact(self, data: str, offset: int, generation: int) -> None:
+        """Replace the snapshot with data, which covers the first offset bytes of the journal
+
+        Meant to be run in a background thread: appends are only blocked while files are renamed
+        """
+        if self._in_memory_only:
+            return
+        temp_path = f"{self.path}.compact.{os.getpid()}"
+        self._write_temp(temp_path, data)
+        with self.file_lock:
+            if generation != self.generation:  # a newer snapshot was written meanwhile
+                os.remove(temp_path)
+                return
+            self._replace(temp_path, len(data))
+            self.trim_journal(offset)
 
     def file_exists(self) -> bool:
         return self._file_exists
@@ -116,10 +240,23 @@ class JsonDB:
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        self._full_write = False
+        self._dirty = set()
 
     def set_modified(self, b):
+        # changes made without a known path are written as a full snapshot
         with self.lock:
             self._modified = b
+            self._full_write = b
+            self._dirty.clear()
+
+    def mark_dirty(self, path=None):
+        with self.lock:
+            self._modified = True
+            if not path:
+                self._full_write = True
+            elif not self._full_write:
+                self._dirty.add(tuple(path))
 
     def modified(self):
         return self._modified
@@ -141,9 +278,11 @@ class JsonDB:
         if value is not None:
             if self.data.get(key) != value:
                 self.data[key] = copy.deepcopy(value)
+                self.mark_dirty([key])
                 return True
         elif key in self.data:
             self.data.pop(key)
+            self.mark_dirty([key])
             return True
         return False
 
@@ -151,20 +290,44 @@ class JsonDB:
     def dump(self) -> str:
         return json.dumps(string_keys(self.data), cls=JSONEncoder)
 
+    def _get_journal_record(self, path):
+        value = self.data
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return {"path": path, "deleted": True}
+            value = value[key]
+        return {"path": path, "value": value}
+
+    @locked
+    def get_journal_records(self) -> list:
+        written = set()
+        records = []
+        # parents go first, their records already contain all the changes of the children
+        for path in sorted(self._dirty, key=len):
+            if any(path[:i] in written for i in range(1, len(path))):
+                continue
+            written.add(path)
+            record = self._get_journal_record(path)
+            record["path"] = [obj_to_string(key) for key in path]
+            records.append(json.dumps(string_keys(record), cls=JSONEncoder))
+        return records
+
     def _should_convert_to_stored_dict(self, key) -> bool:
         return True
 
 
 class StoredObject:
     db = None
+    _path = None
 
     def __setattr__(self, key, value):
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self._path)
         super().__setattr__(key, value)
 
-    def set_db(self, db):
-        self.db = db
+    def set_db(self, db, path=None):
+        object.__setattr__(self, "db", db)
+        object.__setattr__(self, "_path", path)
 
     def to_json(self):
         d = dict(vars(self))
@@ -180,7 +343,6 @@ class StoredDBProperty:
 
     def __set__(self, obj, value):
         obj.db.put(self.name, value)
-        obj.db.set_modified(True)
         obj.save_db()
 
     def __get__(self, obj, objtype=None):
@@ -236,17 +398,17 @@ class StoredDict(dict):
                 v = StoredDict(v, self.db, self.path + [key])
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         super().__setitem__(key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path + [key])
 
     @locked
     def __delitem__(self, key):
         super().__delitem__(key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path + [key])
 
     @locked
     def pop(self, key, v=_RaiseKeyError):
@@ -255,14 +417,14 @@ class StoredDict(dict):
         else:
             r = super().pop(key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path + [key])
         return r
 
     @locked
     def clear(self):
         super().clear()
         if self.db:
-            self.db.set_modified(True)
+            self.db.mark_dirty(self.path)
 
 
 class WalletDB(JsonDB):
@@ -277,6 +439,8 @@ class WalletDB(JsonDB):
         else:
             self.put("version", self.STORAGE_VERSION)
         self._after_upgrade_tasks()
+        # first save after loading writes a fresh snapshot, folding in the replayed journal
+        self.set_modified(True)
 
     def load_data(self, s):
         try:
@@ -347,9 +511,18 @@ class WalletDB(JsonDB):
     def _write(self, storage):
         if not self.modified():
             return
-        storage.write(self.dump())
+        if self._full_write or not storage.file_exists():
+            storage.write(self.dump())
+        else:
+            storage.append(self.get_journal_records())
         self.set_modified(False)
 
+    def prepare_compaction(self, storage):
+        """Flush pending changes and return arguments for storage.compact"""
+        with self.lock:
+            self._write(storage)
+            return self.dump(), storage.log_size, storage.generation
+
     def is_ready_to_be_used(self):
         return not self.requires_upgrade() and self.upgraded
 
@@ -1,12 +1,14 @@
 import asyncio
 import dataclasses
 import inspect
+import itertools
 import json
 import logging
 import sys
 import time
 import traceback
 from base64 import b64decode
+from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
 from decimal import Decimal
@@ -147,6 +149,49 @@ async def periodic_task(self, process_func, interval):
         await asyncio.sleep(max(interval - elapsed, 0))
 
 
+class UpdatesBuffer:
+    """Ring buffer of wallet events, numbered with increasing sequence numbers
+
+    Consumers read with get_since(seq) without removing events, so several of them can poll one wallet.
+    Once the buffer is full, oldest events are dropped and consumers behind them get a gap marker
+    """
+
+    def __init__(self, maxlen):
+        self.events = deque(maxlen=maxlen)
+        self.last_seq = 0
+        self.read_seq = 0  # position of legacy consumers calling get_updates without a sequence number
+        self.dropped = 0
+
+    def append(self, data):
+        if len(self.events) == self.events.maxlen:
+            self.dropped += 1
+        self.last_seq += 1
+        self.events.append(data)
+
+    @property
+    def first_seq(self):
+        return self.last_seq - len(self.events) + 1
+
+    def get_since(self, since):
+        since = max(min(int(since), self.last_seq), 0)
+        gap = since + 1 < self.first_seq
+        offset = max(since + 1 - self.first_seq, 0)
+        return {"updates": list(itertools.islice(self.events, offset, None)), "seq": self.last_seq, "gap": gap}
+
+    def read(self):
+        updates = self.get_since(self.read_seq)["updates"]
+        self.read_seq = self.last_seq
+        return updates
+
+
+def get_updates_stats(buffers):
+    return {
+        "wallets": len(buffers),
+        "buffered": sum(len(buffer.events) for buffer in buffers),
+        "dropped": sum(buffer.dropped for buffer in buffers),
+    }
+
+
 class CastingDataclass:
     def __post_init__(self):
         for field in dataclasses.fields(self):
@@ -245,3 +290,9 @@ def modify_payment_url(key, url, amount):
     qs[key] = amount
     parsed = parsed._replace(query=urlencode(qs))
     return urlunparse(parsed)
+
+
+def get_scan_heights(heights, current_height, max_blocks):
+    # like a separate scan per key capped at its last max_blocks blocks, so every scan ends at current_height
+    # and a single range starting after the lowest height covers all of them
+    return {key: max(height, current_height - max_blocks) for key, height in heights.items()}
@@ -28,7 +28,7 @@ from monero.transaction import Transaction as MoneroTransaction
 from monero.wallet import Wallet as MoneroWallet
 from storage import JSONEncoder as StorageJSONEncoder
 from storage import Storage
-from utils import exception_retry_middleware, load_json_dict, modify_payment_url, rpc
+from utils import UpdatesBuffer, exception_retry_middleware, load_json_dict, modify_payment_url, rpc
 
 MAX_FETCH_TXES = 100
 
@@ -403,7 +403,7 @@ class XMRDaemon(BlockProcessorDaemon):
             db = WalletDB(storage.read())
             wallet = Wallet(self.coin, db, storage)
         self.wallets[wallet_key] = wallet
-        self.wallets_updates[wallet_key] = []
+        self.wallets_updates[wallet_key] = UpdatesBuffer(self.UPDATES_BUFFER_SIZE)
         self.addresses[wallet.address].add(wallet_key)
         await wallet.start(self.latest_blocks.copy())
         return wallet
@@ -0,0 +1,11 @@
+from daemons.utils import get_scan_heights
+
+
+def test_get_scan_heights():
+    # a contract with a stale checkpoint doesn't hold back the up-to-date one
+    heights = get_scan_heights({"fresh": 195, "stale": 5}, 200, 50)
+    assert heights == {"fresh": 195, "stale": 150}
+    from_block = min(heights.values()) + 1
+    assert from_block <= heights["fresh"] + 1
+    # contracts within the window keep their own checkpoints
+    assert get_scan_heights({"a": 180, "b": 190}, 200, 50) == {"a": 180, "b": 190}
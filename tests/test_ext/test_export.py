@@ -1,9 +1,9 @@
-import io
+import json
 
 import pytest
 
 from api import models, utils
-from api.ext.export import db_to_json, json_to_csv, merge_keys
+from api.ext.export import get_leaves, merge_keys, stream_csv, stream_json
 
 
 def test_merge_keys():
@@ -12,17 +12,32 @@ def test_merge_keys():
     assert merge_keys("test", "test") == "test_test"
 
 
-@pytest.mark.anyio
-async def test_invoice_db_to_json(invoice):
+def test_get_leaves():
+    assert get_leaves({"test": 1, "list": [1, 2, 3], "obj": {"obj2": {"field": 4}}}) == {
+        "test": 1,
+        "list": "[1,2,3]",
+        "obj_obj2_field": 4,
+    }
+
+
+async def get_batches():
     items = await models.Invoice.query.gino.all()
     await utils.database.postprocess_func(items)
-    json = list(db_to_json(items))
-    assert len(json) == 1
-    assert isinstance(json[0], dict)
+    yield items
 
 
-def test_json_to_csv():
-    converted = json_to_csv([{"test": 1, "list": [1, 2, 3], "obj": {"obj2": {"field": 4}}}])
-    assert isinstance(converted, io.StringIO)
-    value = converted.getvalue()
-    assert value.strip() == 'list,obj_obj2_field,test\r\n"[1,2,3]",4,1'
+@pytest.mark.anyio
+async def test_stream_json(invoice):
+    data = json.loads("".join([chunk async for chunk in stream_json(get_batches())]))
+    assert len(data) == 1
+    assert data[0]["id"] == invoice["id"]
+    assert "payments" not in data[0]
+
+
+@pytest.mark.anyio
+async def test_stream_csv(invoice):
+    header, row = "".join([chunk async for chunk in stream_csv(get_batches())]).strip().split("\r\n")
+    fields = header.split(",")
+    assert fields == sorted(fields)
+    assert "id" in fields
+    assert invoice["id"] in row
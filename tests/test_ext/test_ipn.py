@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from api import constants, settings, utils
+from api.ext.ipn import IPNDispatcher, get_retry_delay
+
+
+def test_get_retry_delay():
+    assert get_retry_delay(1) == constants.IPN_RETRY_BASE
+    assert get_retry_delay(3) == constants.IPN_RETRY_BASE * 4
+    assert get_retry_delay(100) == constants.IPN_RETRY_MAX
+
+
+@pytest.mark.anyio
+async def test_ipn_dispatcher():
+    dispatcher = IPNDispatcher(prefix=f"ipn_test_{utils.common.unique_id()}")
+    redis = settings.settings.redis_pool
+    job_id = await dispatcher.enqueue("http://localhost:1/ipn", {"id": "test", "status": "paid"}, "test")
+    (job,) = await dispatcher.claim(10)
+    assert job["id"] == job_id
+    assert job["data"] == {"id": "test", "status": "paid"}
+    assert job["attempts"] == 0
+    # leased, not claimed twice
+    assert await dispatcher.claim(10) == []
+    assert await redis.zscore(dispatcher.queue_key, job_id) > time.time()
+    # lease is renewed before posting, unless the job was claimed again meanwhile
+    assert not await dispatcher.renew_lease({**job, "lease": job["lease"] - 1})
+    assert await dispatcher.renew_lease(job)
+    assert await redis.zscore(dispatcher.queue_key, job_id) == job["lease"]
+    await dispatcher.retry(job, "HTTP 500")
+    assert await dispatcher.claim(10) == []
+    assert await redis.zscore(dispatcher.queue_key, job_id) > time.time() + constants.IPN_RETRY_BASE - 1
+    job["attempts"] = constants.IPN_MAX_ATTEMPTS - 1
+    await dispatcher.retry(job, "HTTP 500")
+    assert await redis.zscore(dispatcher.queue_key, job_id) is None
+    (dead,) = await dispatcher.get_dead_letters()
+    assert dead["id"] == job_id
+    assert dead["error"] == "HTTP 500"
+    job_id = await dispatcher.enqueue("http://localhost:1/ipn", {"id": "test", "status": "complete"}, "test")
+    (job,) = await dispatcher.claim(10)
+    await dispatcher.acknowledge(job, latency=2)
+    assert await redis.zscore(dispatcher.queue_key, job_id) is None
+    assert await redis.get(dispatcher.get_job_key(job_id)) is None
+    stats = dispatcher.stats
+    assert stats["delivered"] == 1
+    assert stats["retried"] == 1
+    assert stats["dead_lettered"] == 1
+    assert stats["latency_avg"] == 2
+    await redis.delete(dispatcher.dead_letter_key)
+
+
+@pytest.mark.anyio
+async def test_ipn_object_order():
+    dispatcher = IPNDispatcher(prefix=f"ipn_test_{utils.common.unique_id()}")
+    paid = await dispatcher.enqueue("http://localhost:1/ipn", {"id": "a", "status": "paid"}, "a")
+    complete = await dispatcher.enqueue("http://localhost:1/ipn", {"id": "a", "status": "complete"}, "a")
+    other = await dispatcher.enqueue("http://localhost:1/ipn", {"id": "b", "status": "paid"}, "b")
+    jobs = await dispatcher.claim(10)
+    assert {job["id"] for job in jobs} == {paid, other}
+    # a later IPN of the object waits while the earlier one is retried
+    (job,) = [job for job in jobs if job["id"] == paid]
+    await dispatcher.retry(job, "HTTP 500")
+    await settings.settings.redis_pool.zadd(dispatcher.queue_key, {paid: 0})
+    (job,) = await dispatcher.claim(10)
+    assert job["id"] == paid
+    await dispatcher.acknowledge(job)
+    (job,) = await dispatcher.claim(10)
+    assert job["id"] == complete
+    await dispatcher.acknowledge(job)
+    await dispatcher.acknowledge([job for job in jobs if job["id"] == other][0])
+    assert await settings.settings.redis_pool.exists(dispatcher.objects_key, dispatcher.get_object_key("a")) == 0
@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 import shlex
 import subprocess
@@ -44,6 +45,77 @@ async def test_make_subscriber():
     assert await utils.redis.publish_message("test", {"hello": "world"}) == 1
 
 
+@pytest.mark.anyio
+async def test_websocket_broker():
+    broker = settings.settings.websocket_broker
+    channel = f"invoice:{utils.common.unique_id()}"
+    first = await broker.subscribe(channel)
+    second = await broker.subscribe(channel)
+    assert len(broker.channels[channel]) == 2
+    # both websockets are served by the single pubsub connection of the process
+    # (brokers of other test workers share the redis server, so only a lower bound of receivers is known)
+    assert await utils.redis.publish_message(channel, {"hello": "world"}) >= 1
+    for subscription in (first, second):
+        assert await asyncio.wait_for(subscription.queue.get(), timeout=5) == '{"hello": "world"}'
+    broker.unsubscribe(first)
+    broker.unsubscribe(second)
+    assert channel not in broker.channels
+    assert [message async for message in first.listen()] == []
+    slow = utils.redis.Subscription("invoice:test", maxsize=1)
+    slow.put("1")
+    slow.put("2")
+    assert slow.overflowed
+    assert [message async for message in slow.listen()] == []
+    await broker.close()
+
+
+@pytest.mark.anyio
+async def test_notification_executor():
+    executor = utils.notifications.NotificationExecutor(workers=2)
+    batches = []
+
+    def send_batch(messages):
+        batches.append(messages)
+        return messages.count("fail")
+
+    for message in ["a", "fail", "b"]:
+        executor.submit("test", send_batch, message)
+    assert executor.stats["queue_depth"] == 3
+    assert await executor.run(sum, [1, 2]) == 3
+    while executor.consumers:
+        await asyncio.sleep(0.01)
+    assert batches == [["a", "fail", "b"]]
+    stats = executor.stats
+    assert stats["queue_depth"] == 0
+    assert stats["sent"] == 2
+    assert stats["failed"] == 1
+    assert stats["batches"] == 1
+    await executor.close()
+
+
+@pytest.mark.anyio
+async def test_notification_executor_closes_idle_connections(monkeypatch):
+    monkeypatch.setattr(utils.notifications.constants, "SMTP_IDLE_TIMEOUT", 0.05)
+    executor = utils.notifications.NotificationExecutor(workers=1)
+    quit_calls = []
+
+    class MockServer:
+        def quit(self):
+            quit_calls.append(True)
+
+    key = ("host", 25, "user", "pass", False, False, "test@example.com")
+    executor.connections[key] = (MockServer(), 0)
+    executor.submit(("smtp", *key), lambda messages: 0, "message")
+    while executor.consumers:
+        await asyncio.sleep(0.01)
+    assert ("smtp", *key) in executor.idle_timers
+    while executor.idle_timers or quit_calls == []:
+        await asyncio.sleep(0.01)
+    assert key not in executor.connections
+    assert executor.stats["smtp_connections"] == 0
+    await executor.close()
+
+
 @dataclass
 class MockTemplateObj:
     template_name: str
@@ -117,6 +189,34 @@ async def test_product_template(client, token, user):
     assert template == f"store={store}|product={product_template}|quantity={qty}"
 
 
+@pytest.mark.anyio
+async def test_template_cache(client, token, user):
+    cache = utils.templates.template_cache
+    # users without custom templates are cached too
+    template = await utils.templates.get_template("notification", user_id=user["id"])
+    assert template is settings.settings.template_manager.templates["notification"]
+    assert cache.users.get(user["id"]) == {"ids": {}, "names": {}}
+    resp = await client.post(
+        "/templates",
+        json={"name": "notification", "text": "first"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    template_id = resp.json()["id"]
+    assert cache.users.get(user["id"]) is None
+    template = await utils.templates.get_template("notification", user_id=user["id"])
+    assert template.render() == "first"
+    assert await utils.templates.get_template("notification", user_id=user["id"]) is template
+    resp = await client.patch(
+        f"/templates/{template_id}", json={"text": "second"}, headers={"Authorization": f"Bearer {token}"}
+    )
+    assert resp.status_code == 200
+    assert (await utils.templates.get_template("notification", user_id=user["id"])).render() == "second"
+    resp = await client.delete(f"/templates/{template_id}", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 200
+    template = await utils.templates.get_template("notification", user_id=user["id"])
+    assert template is settings.settings.template_manager.templates["notification"]
+
+
 @pytest.mark.anyio
 async def test_store_template(client, token, user):
     shop = MockTemplateObj(template_name="shop", mock_name="MockShop", user_id=user["id"])
@@ -361,3 +461,94 @@ def test_gen_recovery_code():
     assert code[5] == "-"
     assert all(x in TFA_RECOVERY_ALPHABET for x in code[:5])
     assert all(x in TFA_RECOVERY_ALPHABET for x in code[6:])
+
+
+def test_lru_cache(mocker):
+    cache = utils.cache.LRUCache(maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts least recently used
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.stats == {"hits": 2, "misses": 1, "size": 2}
+    mocker.patch("time.monotonic", return_value=time.monotonic() + 11)
+    assert cache.get("a") is None
+    assert len(cache) == 1
+    assert cache.pop("c") == 3
+    assert cache.pop("c", "default") == "default"
+
+
+@pytest.mark.anyio
+async def test_token_cache(client, user, token):
+    token_cache = utils.authorization.token_cache
+    headers = {"Authorization": f"Bearer {token}"}
+    assert (await client.get("/users/me", headers=headers)).status_code == 200
+    # a local hit, or a redis one if another process invalidated meanwhile
+    hits = token_cache.stats["local_hits"] + token_cache.stats["redis_hits"]
+    resp = await client.get("/users/me", headers=headers)
+    assert resp.status_code == 200
+    assert resp.json()["id"] == user["id"]
+    assert token_cache.stats["local_hits"] + token_cache.stats["redis_hits"] == hits + 1
+    token_cache.clear()
+    assert (await client.get("/users/me", headers=headers)).status_code == 200
+    token_hash = utils.authorization.hash_token(token)
+    assert await settings.settings.redis_pool.sismember(token_cache.user_key(user["id"]), token_hash)
+    cached = await settings.settings.redis_pool.get(token_cache.token_key(token_hash))
+    assert token not in cached
+    assert json.loads(cached).keys() == set(utils.authorization.TOKEN_CACHE_FIELDS)
+    # fills racing with an invalidation are dropped
+    generation = await token_cache.get_generation()
+    data = await utils.authorization.get_token_data(token)
+    await token_cache.invalidate_users(user["id"])
+    await token_cache.set(token, generation, *data)
+    assert await settings.settings.redis_pool.get(token_cache.token_key(token_hash)) is None
+    assert await token_cache.get(token, await token_cache.get_generation()) is None
+    # user changes are visible immediately
+    assert (await client.post("/users/me/settings", json={"balance_currency": "EUR"}, headers=headers)).status_code == 200
+    assert (await client.get("/users/me", headers=headers)).json()["settings"]["balance_currency"] == "EUR"
+    assert (await client.delete(f"/token/{token}", headers=headers)).status_code == 200
+    assert (await client.get("/users/me", headers=headers)).status_code == 401
+    assert await settings.settings.redis_pool.get(token_cache.token_key(token_hash)) is None
+
+
+@pytest.mark.anyio
+async def test_rate_cache(mocker):
+    calls = 0
+
+    async def rate(self, currency):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.1)
+        return Decimal("20000")
+
+    mocker.patch("bitcart.BTC.rate", rate)
+    coin = await settings.settings.get_coin("btc")
+    rates = await asyncio.gather(*(utils.wallets.get_coin_rate(coin, "USD") for _ in range(10)))
+    assert rates == [Decimal("20000")] * 10
+    assert calls == 1  # single daemon request for concurrent lookups
+    assert await utils.wallets.get_coin_rate(coin, "usd") == Decimal("20000")
+    assert calls == 1
+    await utils.wallets.get_coin_rate(coin, "EUR")
+    assert calls == 2
+    settings.settings.rate_cache.clear()
+    await utils.wallets.get_coin_rate(coin, "USD")
+    assert calls == 3
+
+
+@pytest.mark.anyio
+async def test_coin_pool():
+    pool = settings.settings.coin_pool
+    coin = await settings.settings.get_coin("btc", {"xpub": "test", "contract": None})
+    assert await settings.settings.get_coin("btc", {"contract": None, "xpub": "test"}) is coin
+    assert await settings.settings.get_coin("btc", {"xpub": "test2"}) is not coin
+    assert coin.server.session is pool.sessions["btc"]
+    stats = pool.stats
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["size"] == 2
+    assert stats["hit_rate"] == 1 / 3
+    assert stats["open_connections"] == 0
+    await pool.close()
+    assert pool.sessions == {}
+    assert coin.server._sessions == {}
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import asyncio
+import gzip
 import json as json_module
 import os
 import sys
@@ -648,6 +649,34 @@ async def test_export_invoices(client: TestClient, token: str, limited_user):
             await client.get("/invoices/export?all_users=true&add_payments=true", headers={"Authorization": f"Bearer {token}"})
         ).json()[0]
     )
+    ndjson_resp = await client.get(
+        "/invoices/export?all_users=true&export_format=ndjson", headers={"Authorization": f"Bearer {token}"}
+    )
+    assert ndjson_resp.status_code == 200
+    assert [json_module.loads(line) for line in ndjson_resp.text.splitlines()] == data
+    gzip_resp = await client.get("/invoices/export?all_users=true&compress=true", headers={"Authorization": f"Bearer {token}"})
+    assert gzip_resp.status_code == 200
+    assert gzip_resp.headers["content-type"] == "application/gzip"
+    assert ".json.gz" in gzip_resp.headers["content-disposition"]
+    assert json_module.loads(gzip.decompress(gzip_resp.content)) == data
+    assert (
+        await client.get("/invoices/export?export_format=xml", headers={"Authorization": f"Bearer {token}"})
+    ).status_code == 422
+
+
+async def test_invoices_list_related_data(client: TestClient, token: str, user, store):
+    product = await create_product(client, user["id"], token, store_id=store["id"])
+    invoice1 = await create_invoice(client, user["id"], token, store_id=store["id"], products=[product["id"]])
+    invoice2 = await create_invoice(client, user["id"], token, store_id=store["id"])
+    resp = await client.get("/invoices", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 200
+    result = {item["id"]: item for item in resp.json()["result"]}
+    for invoice in (invoice1, invoice2):
+        single = (await client.get(f"/invoices/{invoice['id']}", headers={"Authorization": f"Bearer {token}"})).json()
+        assert result[invoice["id"]] == single
+    assert result[invoice1["id"]]["products"] == [product["id"]]
+    assert result[invoice1["id"]]["product_names"] == {product["id"]: product["name"]}
+    assert result[invoice2["id"]]["products"] == []
 
 
 async def test_batch_commands(client: TestClient, token: str, store):
@@ -880,6 +909,32 @@ async def test_create_invoice_without_coin_rate(client, token: str, mocker, stor
     await client.delete(f"/invoices/{invoice_id}", headers={"Authorization": f"Bearer {token}"})
 
 
+async def test_create_invoices_batch(client, token: str, store):
+    r = await client.post(
+        "/invoices/batch/create",
+        json={
+            "invoices": [
+                {"store_id": store["id"], "price": 5},
+                {"store_id": "unknown", "price": 5},
+                {"store_id": store["id"], "price": 7},
+            ]
+        },
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert r.status_code == 200
+    first, missing, second = r.json()
+    assert first["error"] is None
+    assert first["invoice"]["price"] == "5.00"
+    assert len(first["invoice"]["payments"]) > 0
+    assert missing == {"invoice": None, "error": "Store with id unknown does not exist!"}
+    assert second["invoice"]["price"] == "7.00"
+    assert first["invoice"]["payments"][0]["payment_address"] != second["invoice"]["payments"][0]["payment_address"]
+    assert (await client.get(f"/invoices/{second['invoice']['id']}")).json()["status"] == "pending"
+    assert (
+        await client.post("/invoices/batch/create", json={"invoices": []}, headers={"Authorization": f"Bearer {token}"})
+    ).status_code == 422
+
+
 async def test_create_invoice_and_pay(client, token: str, store):
     store_id = store["id"]
     # create invoice
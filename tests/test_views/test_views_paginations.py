@@ -41,6 +41,33 @@ async def test_next_prev_url(client: TestClient, token: str):
     assert prev_url.endswith("/users?limit=1&offset=1")
 
 
+async def test_cursor_pagination(client: TestClient, token: str):
+    for _ in range(3):
+        await create_user(client)
+    headers = {"Authorization": f"Bearer {token}"}
+    expected = [item["id"] for item in (await client.get("/users?limit=100", headers=headers)).json()["result"]]
+    assert len(expected) >= 4
+    resp = await client.get("/users?limit=2&after=&count=none", headers=headers)
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["count"] is None
+    assert data["previous"] is None
+    ids = [item["id"] for item in data["result"]]
+    while data["next"]:
+        data = (await client.get(data["next"], headers=headers)).json()
+        ids.extend(item["id"] for item in data["result"])
+    assert ids == expected
+    # walk back from the last page
+    previous = (await client.get(data["previous"], headers=headers)).json()
+    assert [item["id"] for item in previous["result"]] == expected[-len(data["result"]) - 2 : -len(data["result"])]
+    assert previous["next"]
+    resp = await client.get("/users?limit=2&after=&count=estimated", headers=headers)
+    assert isinstance(resp.json()["count"], int)
+    assert (await client.get("/users?after=invalid", headers=headers)).status_code == 422
+    assert (await client.get("/users?after=&sort=fake", headers=headers)).status_code == 422
+    assert (await client.get("/users?count=fake", headers=headers)).status_code == 422
+
+
 async def test_undefined_sort(client: TestClient, token: str):
     resp = await client.get("/users?sort=fake", headers={"Authorization": f"Bearer {token}"})
     assert resp.json()["result"] == []
@@ -115,3 +142,23 @@ async def test_date_pagination(client: TestClient, user, token):
     await check_start_date_query(client, token, "-1w", 1, invoice3["id"], start=False)
     await check_start_date_query(client, token, "-1d", 2, invoice2["id"], start=False)
     await check_start_date_query(client, token, "-1h", 3, invoice1["id"], start=False)
+
+
+async def test_text_search(client: TestClient, user, token):
+    invoice = await create_invoice(client, user["id"], token, order_id="search-order-id")
+    await create_invoice(client, user["id"], token)
+    headers = {"Authorization": f"Bearer {token}"}
+    resp = await client.get("/invoices?query=SEARCH-ORDER", headers=headers)
+    assert resp.status_code == 200
+    assert [item["id"] for item in resp.json()["result"]] == [invoice["id"]]
+    # anchors match at column boundaries
+    resp = await client.get(f"/invoices?query={quote('^search-order-id$')}", headers=headers)
+    assert [item["id"] for item in resp.json()["result"]] == [invoice["id"]]
+    address = invoice["payments"][0]["payment_address"]
+    resp = await client.get(f"/invoices?query={quote(address)}", headers=headers)
+    result = {item["id"]: item for item in resp.json()["result"]}
+    assert invoice["id"] in result
+    assert "search_text" not in result[invoice["id"]]["payments"][0]
+    product = await create_product(client, user["id"], token, name="searchable product")
+    resp = await client.get("/products?query=searchable", headers=headers)
+    assert [item["id"] for item in resp.json()["result"]] == [product["id"]]
@@ -13,6 +13,7 @@ from api import settings as settings_module
 from api import tasks
 from api.ext import backups as backup_ext
 from api.ext import configurator as configurator_ext
+from api.ext import ipn as ipn_ext
 from api.ext import tor as tor_ext
 from api.ext import update as update_ext
 from api.logserver import main as start_logserver
@@ -54,12 +55,16 @@ async def main():
         asyncio.ensure_future(run_repeated(update_ext.refresh, 60 * 60 * 24))
         settings.manager.add_event_handler("new_payment", invoices.new_payment_handler)
         settings.manager.add_event_handler("new_block", invoices.new_block_handler)
-        await invoices.create_expired_tasks()  # to ensure invoices get expired actually
+        await invoices.expiration_scheduler.load()  # to ensure invoices get expired actually
+        invoices.expiration_scheduler.start()
+        ipn_ext.dispatcher.start()
         coro = events.start_listening(tasks.event_handler)  # to avoid deleted task errors
         asyncio.ensure_future(coro)
         await settings.plugins.worker_setup()
         await settings.manager.start_websocket(reconnect_callback=invoices.check_pending, force_connect=True)
     finally:
+        await invoices.expiration_scheduler.stop()
+        await ipn_ext.dispatcher.stop()
         await settings.plugins.shutdown()
         await settings.shutdown()
 